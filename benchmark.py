@@ -0,0 +1,436 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#    Copyright (C) 2016 Rodrigo Silva (MestreLion) <linux@rodrigosilva.com>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program. See <http://www.gnu.org/licenses/gpl.html>
+
+
+"""
+    Benchmarks for sunlesssea.py on synthetic game data
+"""
+
+from __future__ import unicode_literals, print_function
+
+
+import sys
+import os
+import argparse
+import logging
+import json
+import random
+import itertools
+import collections
+import platform
+import shutil
+import tempfile
+import time
+
+import sunlesssea
+
+
+log = logging.getLogger(os.path.basename(os.path.splitext(__file__)[0]))
+
+
+
+
+################################################################################
+# Synthetic game data
+
+# Entities generated at scale 1, roughly the size of the game data
+SCALE_1X = dict(
+    qualities = 3000,
+    areas     = 120,
+    events    = 3000,  # root events, each with up to 4 actions
+    exchanges = 40,    # with 3 shops each
+    autosave  = 600,   # qualities possessed
+)
+
+# Words for names and texts, so searches have something to find
+WORDS = ("rose", "zee", "terror", "hunger", "fuel", "echoes", "pigmote",
+         "isle", "lantern", "storm", "salt", "crew", "captain", "mirror",
+         "bone", "tide", "venderbight", "fathom", "hulk", "sun")
+
+
+def generate(datadir, scale=1, seed=0):
+    '''Write a structurally valid game data dir to datadir, with scale times
+        the entities of SCALE_1X: qualities, areas, events with actions,
+        outcomes and LinkToEvent, exchanges, geography/Tiles and
+        saves/Autosave. Same seed and scale always generate the same data
+    '''
+    rnd = random.Random(seed)
+    ids = itertools.count(100000)
+    count = {_: int(n * scale) or 1 for _, n in SCALE_1X.iteritems()}
+
+    def text(words=3):
+        return " ".join(rnd.choice(WORDS) for _ in xrange(words)).capitalize()
+
+    qids = [next(ids) for _ in xrange(count['qualities'])]
+    aids = [next(ids) for _ in xrange(count['areas'])]
+    sids = [next(ids) for _ in xrange(count['areas'])]
+    eids = [next(ids) for _ in xrange(count['events'])]
+
+    def advanced(dice=False):
+        adv = "[q:{}]".format(rnd.choice(qids))
+        if dice:
+            adv = "[d:{}]".format(adv)
+        return adv
+
+    def requirement():
+        data = dict(Id=next(ids), AssociatedQuality=dict(Id=rnd.choice(qids)))
+        key = rnd.choice(('MinLevel', 'MaxLevel', 'DifficultyLevel',
+                          'MinAdvanced', 'DifficultyAdvanced'))
+        if key.endswith('Advanced'):
+            data[key] = advanced()
+        else:
+            data[key] = rnd.randint(1, 10)
+        return data
+
+    def effect():
+        data = dict(Id=next(ids), AssociatedQuality=dict(Id=rnd.choice(qids)))
+        key = rnd.choice(('Level', 'Level', 'SetToExactly', 'ChangeByAdvanced'))
+        if key.endswith('Advanced'):
+            data[key] = advanced(dice=rnd.random() < .5)
+        else:
+            data[key] = rnd.randint(-5, 10)
+        return data
+
+    def outcome(parent):
+        data = dict(Id=next(ids),
+                    Name=rnd.choice(("", text())),
+                    Description="{} [q:{}]".format(text(12), rnd.choice(qids)),
+                    Image=rnd.choice(("", "outcome")),
+                    QualitiesAffected=[effect()
+                                       for _ in xrange(rnd.randint(0, 3))],
+                    ParentEvent=dict(Id=parent))
+        if rnd.random() < .2:
+            data['LinkToEvent'] = dict(Id=rnd.choice(eids))
+        return data
+
+    def action(event):
+        data = dict(Id=next(ids),
+                    Name="{} {}".format(text(), advanced()),
+                    Description="{} [{}]".format(text(8), text(2)),
+                    Image="action",
+                    ParentEvent=dict(Id=event),
+                    QualitiesRequired=[requirement()
+                                       for _ in xrange(rnd.randint(0, 3))])
+        data['DefaultEvent'] = outcome(data['Id'])
+        if rnd.random() < .5:
+            data['SuccessEvent'] = outcome(data['Id'])
+        for key in ('RareDefaultEvent', 'RareSuccessEvent'):
+            if rnd.random() < .05:
+                data[key] = outcome(data['Id'])
+                data[key + 'Chance'] = rnd.randint(5, 20)
+        return data
+
+    qualities = [dict(Id=qid,
+                      Name="{} {}".format(text(2), i),
+                      Description="{} {}".format(text(10), advanced()),
+                      Image="quality{}".format(i % 100),
+                      Category=rnd.choice((0, 1, 1000, 2000, 5000)),
+                      Nature=rnd.choice((1, 2)),
+                      Tag=rnd.choice(("", "Cargo", "Hold")),
+                      Cap=rnd.choice((0, 0, 10, 100)),
+                      DifficultyScaler=rnd.choice((0, 10, 60)),
+                      LevelDescriptionText=(
+                          "~".join("{}|{}".format(_, text())
+                                   for _ in xrange(1, 4))
+                          if rnd.random() < .2 else ""),
+                      ChangeDescriptionText=(
+                          "1|{}".format(text()) if rnd.random() < .1 else ""))
+                 for i, qid in enumerate(qids)]
+
+    areas = [dict(Id=aid,
+                  Name="{} {}".format(text(2), i),
+                  Description=text(10),
+                  ImageName="area{}".format(i),
+                  MoveMessage="You arrive at {}".format(text(2)))
+             for i, aid in enumerate(aids)]
+
+    events = []
+    for i, eid in enumerate(eids):
+        event = dict(Id=eid,
+                     Name="{} {}".format(text(3), i),
+                     Description=text(30),
+                     Image="event{}".format(i % 100),
+                     Autofire=rnd.random() < .2,
+                     Category=rnd.choice((0, 1, 2)),
+                     QualitiesRequired=[requirement()
+                                        for _ in xrange(rnd.randint(0, 3))],
+                     QualitiesAffected=[effect()
+                                        for _ in xrange(rnd.randint(0, 2))],
+                     ChildBranches=[action(eid)
+                                    for _ in xrange(rnd.randint(0, 4))])
+        if rnd.random() < .8:
+            event['LimitedToArea'] = dict(Id=rnd.choice(aids))
+        events.append(event)
+
+    exchanges = [dict(Id=next(ids),
+                      Name=text(2),
+                      SettingIds=rnd.sample(sids, min(2, len(sids))),
+                      Shops=[dict(Id=next(ids),
+                                  Name=text(2),
+                                  Description=text(6),
+                                  Image="shop",
+                                  Availabilities=[
+                                      dict(Id=next(ids),
+                                           Quality=dict(Id=rnd.choice(qids)),
+                                           PurchaseQuality=dict(Id=qids[0]),
+                                           Cost=rnd.randint(0, 500),
+                                           SellPrice=rnd.randint(0, 400))
+                                      for _ in xrange(rnd.randint(1, 15))])
+                             for _ in xrange(3)])
+                 for _ in xrange(count['exchanges'])]
+
+    tiles = [dict(Name="Tiles {}".format(region),
+                  Tiles=[dict(Name=text(2),
+                              PortData=[dict(Name=text(2),
+                                             Area=dict(Id=aid),
+                                             Setting=dict(Id=sid))])
+                         for aid, sid in zip(aids, sids)[region::3]])
+             for region in xrange(3)]
+
+    autosave = dict(QualitiesPossessedList=[
+        dict(AssociatedQualityId=qid,
+             Level=rnd.randint(0, 100),
+             EffectiveLevelModifier=rnd.choice((0, 0, 0, 5)))
+        for qid in rnd.sample(qids, min(count['autosave'], len(qids)))])
+
+    for path, data in (("entities/qualities_import.json", qualities),
+                       ("entities/areas_import.json",     areas),
+                       ("entities/events_import.json",    events),
+                       ("entities/exchanges_import.json", exchanges),
+                       ("geography/Tiles_import.json",    tiles),
+                       ("saves/Autosave.json",            autosave)):
+        path = os.path.join(datadir, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as fd:
+            json.dump(data, fd, separators=(',', ':'))
+
+    log.info("Generated data at scale %s in %s: %s", scale, datadir,
+             ", ".join("{} {}".format(n, _) for _, n in count.iteritems()))
+
+
+
+
+################################################################################
+# Benchmarks
+
+def timed(func, repeat=1, setup=None):
+    '''Time func() repeat times, calling setup() before each, untimed.
+        Return a dict with the times of all runs, first and best
+    '''
+    runs = []
+    for _ in xrange(repeat):
+        if setup:
+            setup()
+        start = time.time()
+        func()
+        runs.append(time.time() - start)
+    return dict(runs=runs, first=runs[0], best=min(runs))
+
+
+def load(datadir, **options):
+    '''Construct SunlessSea and load all its containers'''
+    ss = sunlesssea.SunlessSea(datadir, **options)
+    for name in ('qualities', 'locations', 'events', 'shops', 'autosave'):
+        getattr(ss, name)
+    return ss
+
+
+def benchmark(datadir, repeat=3, sample=20):
+    '''Run all benchmarks on the game data in datadir.
+        Return an ordered dict of {name: timed()} results
+    '''
+    results = collections.OrderedDict()
+
+    def run(name, func, repeat=repeat, setup=None):
+        results[name] = timed(func, repeat, setup)
+        log.info("%-32s best %8.3fs  first %8.3fs", name,
+                 results[name]['best'], results[name]['first'])
+
+    cachedir = tempfile.mkdtemp(prefix='sunlesssea-cache-')
+    try:
+        run("construct", lambda: load(datadir, cache=False))
+        run("construct:compact", lambda: load(datadir, cache=False,
+                                              compact=True), 1)
+        run("construct:lazy", lambda: load(datadir, cache=False,
+                                           lazy=True), 1)
+        run("construct:snapshot-write", lambda: load(datadir,
+                                                     cachedir=cachedir), 1)
+        run("construct:snapshot-read", lambda: load(datadir,
+                                                    cachedir=cachedir))
+    finally:
+        shutil.rmtree(cachedir, ignore_errors=True)
+
+    ss = load(datadir, cache=False)
+    clear = ss.render_cache.clear
+    qualities = list(ss.qualities)[:sample]
+    location = next(_ for _ in ss.locations)
+
+    for word in ("rose", "storm isle", "^nothing$"):
+        run("find:events:{}".format(word),
+            lambda: list(ss.events.find(word)))
+        run("find:events:{}:text".format(word),
+            lambda: list(ss.events.find(word, text=True)))
+    run("find:qualities:rose", lambda: list(ss.qualities.find("rose")))
+
+    # Results may be lazy views, so list() them
+    run("Events.at:id", lambda: list(ss.events.at(lid=location.id)))
+    run("Events.at:name", lambda: list(ss.events.at(name=location.name[:3])))
+
+    run("Quality.usage:x{}".format(len(qualities)),
+        lambda: [_.usage() for _ in qualities], setup=clear)
+    run("Qualities.usage", lambda: ss.qualities.usage(), setup=clear)
+
+    for entity in sunlesssea.EXPORT_ENTITIES:
+        for fmt in ('bare', 'pretty', 'wiki', 'wikipage', 'dump'):
+            run("format:{}:{}".format(entity, fmt),
+                lambda: sunlesssea.query(ss, entity, format=fmt),
+                setup=clear)
+
+    return results
+
+
+def compare(old, new):
+    '''Log the change in best times from old to new benchmark results'''
+    for name, result in new['results'].iteritems():
+        if name not in old['results']:
+            continue
+        before, after = old['results'][name]['best'], result['best']
+        log.info("%-32s %8.3fs -> %8.3fs  %+7.1f%%", name, before, after,
+                 100. * (after - before) / before if before else 0)
+
+
+
+
+################################################################################
+# Main() and helpers
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__)
+
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('-q', '--quiet',
+                       dest='loglevel',
+                       const=logging.WARNING,
+                       default=logging.INFO,
+                       action="store_const",
+                       help="Suppress informative messages.")
+
+    group.add_argument('-v', '--verbose',
+                       dest='loglevel',
+                       const=logging.DEBUG,
+                       action="store_const",
+                       help="Verbose mode, output extra info.")
+
+    parser.add_argument('-s', '--scale',
+                        dest='scale',
+                        type=float,
+                        default=1,
+                        metavar="FACTOR",
+                        help="Size of the synthetic data, as a factor of"
+                            " the game data, such as 1, 10 or 100."
+                            " [Default: %(default)s]")
+
+    parser.add_argument('-d', '--datadir',
+                        dest='datadir',
+                        help="Benchmark the game data in DATADIR instead of"
+                            " generating synthetic data.")
+
+    parser.add_argument('-g', '--generate',
+                        dest='generate',
+                        metavar="DIR",
+                        help="Only generate synthetic data in DIR.")
+
+    parser.add_argument('-r', '--repeat',
+                        dest='repeat',
+                        type=int,
+                        default=3,
+                        metavar="N",
+                        help="Run each benchmark N times, reporting the best"
+                            " and the first run. [Default: %(default)s]")
+
+    parser.add_argument('-o', '--output',
+                        dest='output',
+                        metavar="FILE",
+                        help="Save results as JSON to FILE."
+                            " [Default: print to stdout]")
+
+    parser.add_argument('-c', '--compare',
+                        dest='compare',
+                        metavar="FILE",
+                        help="Compare with results saved in FILE.")
+
+    args = parser.parse_args(argv)
+    args.debug = args.loglevel == logging.DEBUG
+
+    return args
+
+
+
+def main(argv=None):
+    args = parse_args(argv or [])
+    logging.basicConfig(level=args.loglevel,
+                        format='%(levelname)s: %(message)s')
+    # Keep sunlesssea's own info and debug messages out of the timings
+    sunlesssea.log.setLevel(max(args.loglevel, logging.WARNING))
+    log.debug(args)
+
+    if args.generate:
+        generate(args.generate, args.scale)
+        return
+
+    datadir = args.datadir
+    if not datadir:
+        datadir = tempfile.mkdtemp(prefix='sunlesssea-data-')
+        generate(datadir, args.scale)
+    try:
+        results = benchmark(datadir, args.repeat)
+    finally:
+        if not args.datadir:
+            shutil.rmtree(datadir, ignore_errors=True)
+
+    report = collections.OrderedDict((
+        ('date',     time.strftime('%Y-%m-%dT%H:%M:%S')),
+        ('scale',    None if args.datadir else args.scale),
+        ('datadir',  args.datadir),
+        ('repeat',   args.repeat),
+        ('python',   platform.python_version()),
+        ('platform', platform.platform()),
+        ('results',  results),
+    ))
+
+    if args.compare:
+        with open(args.compare) as fd:
+            compare(json.load(fd), report)
+
+    if args.output:
+        with open(args.output, 'w') as fd:
+            json.dump(report, fd, indent=1, separators=(',', ': '))
+    else:
+        print(json.dumps(report, indent=1, separators=(',', ': ')))
+
+
+
+
+if __name__ == '__main__':
+    try:
+        sys.exit(main(sys.argv[1:]))
+    except Exception as e:
+        log.critical(e, exc_info=True)
+        sys.exit(1)
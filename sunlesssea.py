@@ -44,12 +44,32 @@ from __future__ import unicode_literals, print_function
 
 import sys
 import os
+import stat
+import errno
 import argparse
 import logging
 import json
+import glob
 import re
+import string
 import math
+import time
 import collections
+import operator
+import sre_parse
+import sre_constants
+import hashlib
+import gc
+import contextlib
+import mmap
+import signal
+import socket
+import SocketServer
+import BaseHTTPServer
+import httplib
+import multiprocessing
+import multiprocessing.pool
+import cPickle as pickle
 
 
 log = logging.getLogger(os.path.basename(os.path.splitext(__file__)[0]))
@@ -74,11 +94,118 @@ def safeprint(text=""):
 
 
 
+def safestream(chunks, fd=None, bufsize=65536):
+    '''Like safeprint(), for text coming in chunks, such as from the iter_*()
+        renderers, written to fd (default stdout) as they are generated,
+        buffered in blocks of about bufsize bytes
+    '''
+    if fd is None:
+        fd = sys.stdout
+    encoding = getattr(fd, 'encoding', None) or 'UTF-8'
+    buf, size = [], 0
+    for chunk in chunks:
+        data = unicode(chunk).encode(encoding)
+        buf.append(data)
+        size += len(data)
+        if size >= bufsize:
+            fd.write(b"".join(buf))
+            fd.flush()
+            buf, size = [], 0
+    buf.append(b"\n")
+    fd.write(b"".join(buf))
+    fd.flush()
+
+
+
+def iterjoin(sep, iterable):
+    '''Like sep.join(iterable), but generating the pieces and separators'''
+    for i, item in enumerate(iterable):
+        if i:
+            yield sep
+        yield item
+
+
+
 def format_obj(fmt, obj, *args, **kwargs):
-    objdict = {_:getattr(obj, _) for _ in vars(obj) if not _.startswith('_')}
-    objdict.update(dict(str=str(obj), repr=repr(obj)))
+    '''Format fmt with the public attributes of obj as keyword fields, plus
+        {str} and {repr} of it. Only the fields fmt references are fetched,
+        kwargs taking precedence over them
+    '''
+    fmt, fields = compile_format(fmt)
+    objdict = {}
+    objvars = getattr(obj, '__dict__', {})
+    for name in fields:
+        if name in kwargs:
+            continue
+        if name == 'str':
+            objdict[name] = str(obj)
+        elif name == 'repr':
+            objdict[name] = repr(obj)
+        elif name.startswith('_'):
+            continue
+        elif name in objvars:
+            objdict[name] = objvars[name]
+        elif name in public_slots(type(obj)):
+            try:
+                objdict[name] = getattr(obj, name)
+            except AttributeError:
+                pass  # slot not set
     objdict.update(kwargs)
-    return unicode(fmt).format(*args, **objdict)
+    return fmt.format(*args, **objdict)
+
+
+
+_formats = {}  # cache for compile_format()
+
+def compile_format(fmt):
+    '''Parse a format string once, returning it as unicode and the names of
+        the keyword fields it references, including nested ones in specs
+    '''
+    compiled = _formats.get(fmt)
+    if compiled is None:
+        fields = set()
+        for _, field, spec, _ in string.Formatter().parse(unicode(fmt)):
+            if field:
+                name = re.match(r'[^.[]*', field).group()
+                if name and not name.isdigit():
+                    fields.add(name)
+            if spec:
+                fields.update(compile_format(spec)[1])
+        compiled = _formats[fmt] = (unicode(fmt), tuple(fields))
+    return compiled
+
+
+
+_slotnames = {}  # cache for public_slots()
+
+def public_slots(cls):
+    '''Public __slots__ names of a class, including inherited ones, and
+        those of its properties and lazy attributes, as these replace
+        instance attributes in slotted classes
+    '''
+    if cls not in _slotnames:
+        _slotnames[cls] = set(_ for c in cls.__mro__
+                              for _ in getattr(c, '__slots__', ())
+                              if not _.startswith('_'))
+        _slotnames[cls].update(
+            name for c in cls.__mro__
+            for name, attr in vars(c).iteritems()
+            if isinstance(attr, (property, lazyattr, lazyslot)) and
+            not name.startswith('_'))
+    return _slotnames[cls]
+
+
+
+def same_data(a, b):
+    '''Strict equality of JSON-like data. Unlike ==, 1 is not True here'''
+    if type(a) is not type(b):
+        return False
+    if isinstance(a, dict):
+        return len(a) == len(b) and all(_ in b and same_data(a[_], b[_])
+                                        for _ in a)
+    if isinstance(a, list):
+        return len(a) == len(b) and all(same_data(*_) for _ in zip(a, b))
+    return a == b
 
 
 
@@ -94,6 +221,167 @@ def indent(text, level=1, pad='\t'):
 
 
 
+def trigrams(text):
+    '''Set of all lowercase 3-character substrings of a text'''
+    text = text.lower()
+    return set(text[i:i+3] for i in xrange(len(text) - 2))
+
+
+
+def regex_trigrams(pattern):
+    '''Trigrams that any case-insensitive match of a regular expression
+        must contain, from its top-level literal runs. Conservative: might
+        return none at all, for example for '(foo|bar)'
+    '''
+    try:
+        parsed = sre_parse.parse(pattern)
+    except (sre_constants.error, ValueError, TypeError):
+        return set()  # Let re.compile() complain
+
+    runs, run = [], []
+    for op, av in parsed:
+        if op == sre_constants.LITERAL:
+            run.append(unichr(av))
+        else:
+            runs.append(run)
+            run = []
+    runs.append(run)
+
+    return set().union(*(trigrams("".join(_)) for _ in runs))
+
+
+
+class lazyattr(object):
+    '''Decorator for an attribute computed on first access, and then cached
+        as a regular instance attribute. Deleting the attribute resets it
+    '''
+    def __init__(self, func):
+        self.func = func
+        self.__name__ = func.__name__
+        self.__doc__ = func.__doc__
+
+    def __get__(self, obj, cls=None):
+        if obj is None:
+            return self
+        value = obj.__dict__[self.__name__] = self.func(obj)
+        return value
+
+
+
+class lazyslot(object):
+    '''Decorator for an attribute computed on first access, and then cached
+        in a private "_<name>" attribute, that MUST be initialized to None.
+        Unlike lazyattr, also works with __slots__
+    '''
+    def __init__(self, func):
+        self.func = func
+        self.attr = '_' + func.__name__
+        self.__name__ = func.__name__
+        self.__doc__ = func.__doc__
+
+    def __get__(self, obj, cls=None):
+        if obj is None:
+            return self
+        value = getattr(obj, self.attr)
+        if value is None:
+            value = self.func(obj)
+            setattr(obj, self.attr, value)
+        return value
+
+
+
+@contextlib.contextmanager
+def gc_paused():
+    '''Disable the cyclic garbage collector while creating lots of objects,
+        which otherwise triggers it over and over for no gain
+    '''
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+
+class LRUCache(object):
+    '''Mapping of bounded size, evicting the least recently used items.
+        Counts hits and misses of get().
+        Items are kept in a circular doubly linked list of
+        [prev, next, key, value] links, faster than an OrderedDict
+    '''
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.hits    = 0
+        self.misses  = 0
+        self._links  = {}
+        self._root   = root = []  # before the oldest and after the newest
+        root[:] = [root, root, None, None]
+
+
+    def get(self, key, default=None):
+        link = self._links.get(key)
+        if link is None:
+            self.misses += 1
+            return default
+
+        # Move to the newest end
+        prev, next_, _, value = link
+        prev[1] = next_
+        next_[0] = prev
+        root = self._root
+        last = root[0]
+        last[1] = root[0] = link
+        link[0] = last
+        link[1] = root
+        self.hits += 1
+        return value
+
+
+    def __setitem__(self, key, value):
+        links, root = self._links, self._root
+        if key in links:
+            self.get(key)
+            links[key][3] = value
+            self.hits -= 1  # not a lookup
+            return
+
+        if len(links) >= self.maxsize:
+            # Reuse the root as the new link, the oldest becomes the root
+            root[2] = key
+            root[3] = value
+            links[key] = root
+            self._root = root[1]
+            del links[self._root[2]]
+            self._root[2] = self._root[3] = None
+            return
+
+        last = root[0]
+        last[1] = root[0] = links[key] = [last, root, key, value]
+
+
+    def clear(self):
+        self._links.clear()
+        root = self._root
+        root[:] = [root, root, None, None]
+
+
+    def __len__(self):
+        return len(self._links)
+
+
+    def __unicode__(self):
+        return "<{}: {:d}/{:d}, {:d} hits, {:d} misses>".format(
+            self.__class__.__name__, len(self), self.maxsize,
+            self.hits, self.misses)
+
+
+    def __str__(self):
+        return self.__unicode__().encode('utf-8')
+
+
+
 def iif(cond, trueval, falseval=""):
     if cond:
         return trueval
@@ -106,6 +394,97 @@ def iif(cond, trueval, falseval=""):
 ################################################################################
 # Main() and helpers
 
+def json_decoder(ordered=False, intern=None):
+    '''JSON decoder interning keys and strings with intern(),
+        or a private table if None
+    '''
+    if intern is None:
+        strings = {}
+        intern = lambda text: strings.setdefault(text, text)
+
+    factory = collections.OrderedDict if ordered else dict
+    def hook(pairs):
+        return factory((intern(k), intern(v) if isinstance(v, unicode) else v)
+                       for k, v in pairs)
+
+    # strict=False to allow tabs inside strings
+    return json.JSONDecoder(strict=False, object_pairs_hook=hook)
+
+
+
+def load_json(path, ordered=False, intern=None):
+    '''Parse a JSON data file, see json_decoder().
+        Module level so it can run in a process pool
+    '''
+    with open(path) as fd:
+        return json_decoder(ordered, intern).decode(fd.read())
+
+
+
+def iter_json(path, ordered=False, intern=None, chunksize=2**20,
+              offsets=False):
+    '''Parse a JSON data file holding an array, yielding one item at a time,
+        so only the current item and a chunk of the file are in memory.
+        If offsets, yield (item, byte offset, byte length) instead.
+        The file is opened right away, so IOError is not deferred
+    '''
+    return _iter_json_array(open(path, 'rb'), json_decoder(ordered, intern),
+                            chunksize, offsets)
+
+
+_re_json_space = re.compile(r'[ \t\n\r]*')
+
+def _iter_json_array(fd, decoder, chunksize, offsets=False):
+    with fd:
+        buf, pos, state = "", 0, 'start'
+        base = 0  # file offset of buf
+        while True:
+            pos = _re_json_space.match(buf, pos).end()
+            if pos == len(buf):
+                base += len(buf)
+                buf, pos = fd.read(chunksize), 0
+                if not buf:
+                    raise ValueError("Unexpected end of JSON data in {}"
+                                     .format(fd.name))
+                continue
+
+            char = buf[pos]
+            if state == 'start':
+                if not char == '[':
+                    raise ValueError("Expecting JSON array in {}"
+                                     .format(fd.name))
+                pos, state = pos + 1, 'first'
+            elif char == ']' and state in ('first', 'next'):
+                return
+            elif state == 'next':
+                if not char == ',':
+                    raise ValueError("Expecting , delimiter in {}"
+                                     .format(fd.name))
+                pos, state = pos + 1, 'item'
+            else:
+                try:
+                    item, end = decoder.raw_decode(buf, pos)
+                    # Only arrays and objects are known to be complete
+                    error = (None if end < len(buf) or
+                             isinstance(item, (dict, list)) else
+                             ValueError("Truncated JSON data"))
+                except ValueError as e:
+                    error = e  # most likely an item cut at the buffer end
+
+                if error:
+                    # Read more, at least doubling the item's buffer
+                    chunk = fd.read(max(chunksize, len(buf) - pos))
+                    if not chunk:
+                        raise error
+                    base += pos
+                    buf, pos = buf[pos:] + chunk, 0
+                    continue
+
+                yield (item, base + pos, end - pos) if offsets else item
+                pos, state = end, 'next'
+
+
+
 def get_datadir():
     # Linux and FreeBSD
     if sys.platform.startswith("linux") or sys.platform.startswith("freebsd"):
@@ -127,6 +506,24 @@ def get_datadir():
 
 
 
+def get_cachedir():
+    # Linux and FreeBSD
+    if sys.platform.startswith("linux") or sys.platform.startswith("freebsd"):
+        import xdg.BaseDirectory as xdg
+        return os.path.join(xdg.xdg_cache_home, "sunlesssea")
+
+    # Mac OSX
+    elif sys.platform == "darwin":
+        return os.path.expanduser("~/Library/Caches/sunlesssea")
+
+    # Windows
+    elif sys.platform == "win32":
+        return os.path.expanduser("~\\AppData\\Local\\sunlesssea\\cache")
+
+    return "."
+
+
+
 def parse_args(argv=None):
     parser = argparse.ArgumentParser(
         description=__doc__)
@@ -156,6 +553,67 @@ def parse_args(argv=None):
                         default=get_datadir(),
                         help="Game data directory. [Default: %(default)s]")
 
+    parser.add_argument('-C', '--cachedir',
+                        dest='cachedir',
+                        default=get_cachedir(),
+                        help="Directory for the parsed data snapshot cache."
+                            " [Default: %(default)s]")
+
+    parser.add_argument('-n', '--no-cache',
+                        dest='cache',
+                        action="store_false",
+                        default=True,
+                        help="Do not read or write the snapshot cache,"
+                            " always parse the game data files.")
+
+    parser.add_argument('-l', '--lazy',
+                        dest='lazy',
+                        action="store_true",
+                        default=False,
+                        help="Only create Event actions, outcomes, requirements"
+                            " and effects when needed. Faster for filtered"
+                            " queries, but warnings about broken references"
+                            " are delayed or never shown.")
+
+    parser.add_argument('-k', '--compact',
+                        dest='compact',
+                        action="store_true",
+                        default=False,
+                        help="Drop raw JSON data after parsing, rebuilding"
+                            " it for 'dump'. Saves memory, takes longer.")
+
+    parser.add_argument('-j', '--jobs',
+                        dest='workers',
+                        type=int,
+                        default=0,
+                        metavar="N",
+                        help="Parse data files in parallel with N workers.")
+
+    parser.add_argument('-P', '--processes',
+                        dest='processes',
+                        action="store_true",
+                        default=False,
+                        help="Use worker processes instead of threads."
+                            " They parse without holding each other back,"
+                            " but parsed data is copied back to this process"
+                            " and strings are shared only within each file,"
+                            " so this is often slower and uses more memory.")
+
+    parser.add_argument('-s', '--stream',
+                        dest='stream',
+                        action="store_true",
+                        default=False,
+                        help="Build events while parsing their data file."
+                            " Along with --compact, lowers peak memory.")
+
+    parser.add_argument('-r', '--random-access',
+                        dest='random_access',
+                        action="store_true",
+                        default=False,
+                        help="Parse each event only when first accessed,"
+                            " using an index of their offsets in the data"
+                            " file. Always on for '-e events -i ID'.")
+
     parser.add_argument('-f', '--format',
                         dest='format',
                         choices=('bare', 'dump', 'pretty', 'wiki', 'wikipage'),
@@ -182,6 +640,63 @@ def parse_args(argv=None):
                             " Available entities: [%(choices)s]."
                             " [Default: %(default)s]")
 
+    parser.add_argument('-t', '--text',
+                        dest='text',
+                        action="store_true",
+                        default=False,
+                        help="FILTER also searches descriptions, messages,"
+                            " and the actions and outcomes of events.")
+
+    parser.add_argument('-b', '--batch',
+                        dest='batch',
+                        metavar="FILE",
+                        help="Run queries from FILE, or stdin if '-',"
+                            " as JSON lines with keys named like the long"
+                            " options above plus 'filter' and 'output'."
+                            " Options given here are the defaults.")
+
+    parser.add_argument('-i', '--id',
+                        dest='eid',
+                        type=int,
+                        metavar="ID",
+                        help="Only the entity with this ID.")
+
+    parser.add_argument('--serve',
+                        dest='serve',
+                        metavar="ADDRESS",
+                        help="Keep data loaded and serve queries on ADDRESS,"
+                            " a Unix socket path or [HOST:]PORT for HTTP."
+                            " Data is reloaded when data files change.")
+
+    parser.add_argument('--connect',
+                        dest='connect',
+                        metavar="ADDRESS",
+                        help="Run the query on a server started with --serve."
+                            " Data options are ignored.")
+
+    parser.add_argument('--diff',
+                        dest='diff',
+                        metavar="DATADIR",
+                        help="Compare with the game data in DATADIR, listing"
+                            " entities added (+), removed (-) and changed (~)"
+                            " there.")
+
+    parser.add_argument('--export',
+                        dest='export',
+                        metavar="DIR",
+                        help="Write the wiki page of each entity to its own"
+                            " file in DIR, rendered by the -j workers as"
+                            " processes where they can be forked,"
+                            " rewriting only changed ones."
+                            " All entities unless one is given with -e.")
+
+    parser.add_argument('--prettify',
+                        dest='prettify',
+                        metavar="DIR",
+                        help="Copy and 'prettify' the game JSON files to DIR"
+                            " for easy reading and editing, using the -j"
+                            " workers as processes, skipping unchanged ones.")
+
     parser.add_argument(dest='filter',
                         nargs='?',
                         metavar="FILTER",
@@ -194,6 +709,589 @@ def parse_args(argv=None):
 
 
 
+QUERY_ENTITIES = ('locations', 'qualities', 'events', 'shops', 'autosave')
+QUERY_KEYS = ('entity', 'filter', 'method', 'format', 'text', 'eid')
+
+def query(ss, entity, filter=None, method=None, format=None, text=False,
+          eid=None):
+    '''Run a query, with the same meaning as command line arguments.
+        Return its output as text, or None if there are no results or the
+        query is invalid, logging why
+    '''
+    chunks = iter_query(ss, entity, filter=filter, method=method,
+                        format=format, text=text, eid=eid)
+    if chunks is None:
+        return None
+    return "".join(chunks)
+
+
+
+def iter_query(ss, entity, filter=None, method=None, format=None, text=False,
+               eid=None):
+    '''Like query(), but return the output as an iterable of text chunks,
+        rendered as they are consumed, for safestream()
+    '''
+    if entity not in QUERY_ENTITIES:
+        log.error("Invalid entity %r, choose from: %s", entity,
+                  ", ".join(QUERY_ENTITIES))
+        return None
+
+    if entity == "autosave":
+        entities = ss.autosave.qualities
+    else:
+        entities = getattr(ss, entity)
+        log.debug(entities)
+
+    if eid is not None:
+        # get() parses only this entity in random access mode, see --id
+        found = entities.get(eid)
+        entities = entities._derive(subset=[found] if found else [])
+    entities = entities.find(filter, text=text)
+
+    if entity == "autosave":
+        output = "\n".join(unicode(_) for _ in entities)
+        return [output] if output else None
+
+    if not entities:
+        log.error("No %s found for %r%s", entity, filter,
+                  iif(eid is not None, " with ID {}".format(eid)))
+        return None
+    if method == 'usage':
+        if not entity == 'qualities':
+            log.error("Method 'usage' only available for qualities")
+            return None
+        return entities.iter_usage(format)
+    elif method:
+        log.error("Invalid method %r", method)
+        return None
+
+    if format == 'wiki':
+        return entities.iter_wikitable()
+    elif format == 'wikipage':
+        return entities.iter_wikipage()
+    elif format == 'pretty':
+        return entities.iter_pretty()
+    elif format == 'dump':
+        return entities.iter_dump()
+    else:
+        return iterjoin("\n", (_.bare() for _ in entities))
+
+
+
+def batch(ss, path, **defaults):
+    '''Run queries read from a file, or stdin if path is '-', one JSON
+        object per line with query() arguments as keys, using defaults
+        for missing ones. Key 'output' is a file to write the results to,
+        stdout if missing or '-'. Blank lines and lines starting with '#'
+        are skipped. Timings are logged for each query. Invalid or failed
+        queries are logged, and a {"line": N, "error": MESSAGE} JSON line
+        is written to their output instead, or after what was already
+        written, or to stdout if their output can't be opened, and the
+        batch goes on
+    '''
+    fd = sys.stdin if path == '-' else open(path)
+    start = time.time()
+    # Create containers up front, so query timings don't include loading
+    for name in ('qualities', 'locations', 'events', 'shops'):
+        getattr(ss, name)
+    log.info("Loaded data in %.3f seconds", time.time() - start)
+    count = failed = 0
+    with fd:
+        for lineno, line in enumerate(fd, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            count += 1
+            try:
+                spec = json.loads(line)
+                if not isinstance(spec, dict):
+                    raise ValueError("not a JSON object")
+                unknown = set(spec) - set(QUERY_KEYS) - {'output'}
+                if unknown:
+                    raise ValueError("unknown keys: {}".format(
+                        ", ".join(sorted(unknown))))
+                entity = spec.get('entity', defaults.get('entity'))
+                if entity not in QUERY_ENTITIES:
+                    raise ValueError("invalid entity {!r}".format(entity))
+            except ValueError as e:
+                log.error("Invalid query in line %d: %s", lineno, e)
+                _batch_error(lineno, "Invalid query: {}".format(e))
+                failed += 1
+                continue
+
+            params = dict(defaults)
+            params.update(spec)
+            output = params.pop('output', '-')
+            qstart = time.time()
+            try:
+                out = None if output == '-' else open(output, 'w')
+            except IOError as e:
+                log.error("Could not write output of line %d: %s", lineno, e)
+                _batch_error(lineno, "Could not write output: {}".format(e))
+                failed += 1
+                continue
+
+            try:
+                result = iter_query(ss, **params)
+                if result is not None:
+                    safestream(result, out)
+            except Exception as e:
+                log.exception("Query in line %d failed: %s", lineno, e)
+                _batch_error(lineno, e, out)
+                failed += 1
+            finally:
+                if out:
+                    out.close()
+            log.info("Query in line %d took %.3f seconds: %s",
+                     lineno, time.time() - qstart, line)
+
+    log.info("Ran %d queries in %.3f seconds, %d failed", count,
+             time.time() - start, failed)
+    log.debug("Render cache: %s", ss.render_cache)
+
+
+
+def _batch_error(lineno, error, out=None):
+    # Error record written by batch() in place of a query output
+    safestream([json.dumps({'line': lineno, 'error': unicode(error)})], out)
+
+
+
+EXPORT_ENTITIES = ('locations', 'qualities', 'events', 'shops')
+
+_export = {}  # state inherited by forked export() workers
+
+def export(ss, outdir, names=EXPORT_ENTITIES, workers=0):
+    '''Write the wiki page of every entity to its own file in outdir, as
+        NAME/ID.wiki, and their table as NAME.wiki. Pages are rendered by a
+        pool of workers processes forked after loading, so they share the
+        entities instead of receiving them pickled. Files are written only
+        if their content hash changed since the last export, as recorded in
+        outdir/.hashes.json, and pages of removed entities are deleted.
+        Where processes can't be forked, pages are rendered here instead.
+        Return the number of files written
+    '''
+    start = time.time()
+    if workers and sys.platform == "win32":
+        # Spawned workers would not inherit _export
+        log.info("Ignoring %d workers, processes can't be forked on Windows",
+                 workers)
+        workers = 0
+    manifest = os.path.join(outdir, '.hashes.json')
+    hashes = _read_hashes(manifest)
+
+    ss.preload(*names)
+    tasks, order = [], {}
+    for name in names:
+        if not os.path.isdir(os.path.join(outdir, name)):
+            os.makedirs(os.path.join(outdir, name))
+        order[name] = [_.id for _ in getattr(ss, name)]
+        tasks.extend((name, order[name][i:i+100])
+                     for i in xrange(0, len(order[name]), 100))
+
+    # Workers are forked only now, with all entities loaded
+    _export.update(ss=ss, outdir=outdir, hashes=hashes)
+    pool = None
+    if workers:
+        pool = multiprocessing.Pool(workers, gc.disable)
+        results = pool.imap_unordered(_export_pages, tasks)
+    else:
+        results = (_export_pages(_) for _ in tasks)
+
+    rows, newhashes, written = collections.defaultdict(dict), {}, 0
+    try:
+        for name, pages in results:
+            for eid, path, digest, row, changed in pages:
+                rows[name][eid] = row
+                newhashes[path] = digest
+                written += changed
+        if pool:
+            pool.close()
+            pool.join()
+
+        for name in names:
+            path = name + '.wiki'
+            digest, changed = _export_write(path, "".join(
+                getattr(ss, name).iter_wikitable(
+                    rows[name][_] for _ in order[name])))
+            newhashes[path] = digest
+            written += changed
+    finally:
+        if pool:
+            pool.terminate()
+        _export.clear()
+
+    prefixes = tuple(_ + '/' for _ in names)
+    for path in set(hashes) - set(newhashes):
+        if path.startswith(prefixes):
+            try:
+                os.remove(os.path.join(outdir, path))
+            except OSError as e:
+                log.warning("Could not remove %s: %s", path, e)
+        else:
+            newhashes[path] = hashes[path]  # from entities not exported now
+
+    _write_hashes(manifest, newhashes)
+
+    log.info("Exported %d pages to %s in %.3f seconds, %d files written",
+             sum(len(_) for _ in order.itervalues()), outdir,
+             time.time() - start, written)
+    return written
+
+
+def _export_pages(task):
+    # Runs in export() workers: render and write a batch of entity pages
+    name, ids = task
+    entities = getattr(_export['ss'], name)
+    pages = []
+    for eid in ids:
+        entity = entities.get(eid)
+        path = "{}/{}.wiki".format(name, eid)
+        digest, changed = _export_write(path, entity.wikipage().strip())
+        pages.append((eid, path, digest, entity.wikirow(), changed))
+    return name, pages
+
+
+def _read_hashes(manifest):
+    # Hashes of files written by a previous export() or prettify()
+    try:
+        with open(manifest) as fd:
+            return json.load(fd)
+    except IOError:
+        return {}
+    except ValueError as e:
+        log.warning("Ignoring invalid hashes in %s: %s", manifest, e)
+        return {}
+
+
+def _write_hashes(manifest, hashes):
+    with open(manifest, 'w') as fd:
+        json.dump(hashes, fd, indent=1, sort_keys=True,
+                  separators=(',', ': '))
+
+
+def _export_write(path, text):
+    # Write text to path in the export() output dir if its hash changed
+    data = text.encode('utf-8') + b"\n"
+    digest = hashlib.sha1(data).hexdigest()
+    filename = os.path.join(_export['outdir'], path)
+    if (_export['hashes'].get(path) == digest and
+        os.path.exists(filename)):
+        return digest, False
+    with open(filename, 'wb') as fd:
+        fd.write(data)
+    return digest, True
+
+
+
+def prettify(indir, outdir, workers=0, indent=1):
+    '''Copy the game JSON files in indir subdirectories to the same ones in
+        outdir, "prettified" for easy reading and editing: keys sorted and
+        a tab per nesting level. Files with an _import.json alternative are
+        skipped in favor of it, except in 'constants', where the _import.json
+        ones are invalid JSON and skipped instead. Files are processed by a
+        pool of workers processes, and only if their contents changed since
+        the last run, as recorded in outdir/.hashes.json.
+        Replaces the former 'import' script. Return the number of files written
+    '''
+    start = time.time()
+    manifest = os.path.join(outdir, '.hashes.json')
+    hashes = _read_hashes(manifest)
+
+    tasks = []
+    for infile in sorted(glob.glob(os.path.join(indir, '*', '*.json'))):
+        dirbase = os.path.basename(os.path.dirname(infile))
+        if dirbase == 'constants':
+            if infile.rpartition('_')[2] == 'import.json':
+                continue
+        elif os.path.isfile(os.path.splitext(infile)[0] + '_import.json'):
+            continue
+
+        if not os.path.isdir(os.path.join(outdir, dirbase)):
+            os.makedirs(os.path.join(outdir, dirbase))
+        path = "{}/{}".format(dirbase, os.path.basename(infile))
+        tasks.append((infile, outdir, path, hashes.get(path), indent))
+
+    pool = None
+    if workers:
+        pool = multiprocessing.Pool(workers)
+        results = pool.imap_unordered(_prettify_file, tasks)
+    else:
+        results = (_prettify_file(_) for _ in tasks)
+
+    written = 0
+    try:
+        for path, digest, changed in results:
+            if digest:
+                hashes[path] = digest
+            else:
+                hashes.pop(path, None)
+            written += changed
+        if pool:
+            pool.close()
+            pool.join()
+    finally:
+        if pool:
+            pool.terminate()
+
+    _write_hashes(manifest, hashes)
+    log.info("Prettified %d files to %s in %.3f seconds, %d written",
+             len(tasks), outdir, time.time() - start, written)
+    return written
+
+
+def _prettify_file(task):
+    # Runs in prettify() workers. Same output as the former 'import' script:
+    # json.dump() piped to unexpand --first-only and sed 's/^\t//'
+    infile, outdir, path, oldhash, indent = task
+    outfile = os.path.join(outdir, path)
+    with open(infile, 'rb') as fd:
+        data = fd.read()
+    digest = hashlib.sha1(data).hexdigest()
+    if digest == oldhash and os.path.exists(outfile):
+        return path, digest, False
+
+    log.info("Saving %s", outfile)
+    try:
+        text = json.dumps(json.loads(data, strict=False), sort_keys=True,
+                          indent=indent, separators=(",", ": "))
+    except ValueError as e:
+        log.error("Could not parse %s: %s", infile, e)
+        return path, None, False
+
+    lines = text.split('\n')
+    for i, line in enumerate(lines):
+        level = (len(line) - len(line.lstrip(' '))) // indent
+        if level:
+            lines[i] = (level - 1) * '\t' + line.lstrip(' ')
+    with open(outfile, 'wb') as fd:
+        fd.write('\n'.join(lines).encode('utf-8'))
+    return path, digest, True
+
+
+
+class _LogCapture(logging.Handler):
+    '''Collect log messages, to send them to a client'''
+    def __init__(self, level=logging.WARNING):
+        super(_LogCapture, self).__init__(level)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append((record.levelno, record.getMessage()))
+
+
+
+class QueryServer(object):
+    '''Mixin for servers keeping a SunlessSea loaded to run queries.
+        Data is reloaded if data files change, see SunlessSea.reload().
+        Requests are handled one at a time, as SunlessSea is not thread-safe
+    '''
+    def setup_ss(self, **options):
+        self.ss = SunlessSea(**options)
+        self.warm_up()
+
+
+    def warm_up(self):
+        for name in ('qualities', 'locations', 'events', 'shops'):
+            getattr(self.ss, name)
+
+
+    def run_query(self, spec):
+        '''Run a query from a dict of query() arguments. Return a dict
+            with the output and logged warnings and errors, to send back
+        '''
+        start = time.time()
+        if self.ss.outdated():
+            log.info("Data files changed, reloading")
+            self.ss.reload()
+            self.warm_up()
+
+        capture = _LogCapture()
+        log.addHandler(capture)
+        try:
+            unknown = set(spec) - set(QUERY_KEYS)
+            if unknown:
+                log.error("Invalid query, unknown keys: %s",
+                          ", ".join(sorted(unknown)))
+                output = None
+            else:
+                output = query(self.ss, **spec)
+        except Exception as e:
+            log.exception("Query %r failed: %s", spec, e)
+            output = None
+        finally:
+            log.removeHandler(capture)
+
+        elapsed = time.time() - start
+        log.info("Query took %.3f seconds: %r", elapsed, spec)
+        log.debug("Render cache: %s", self.ss.render_cache)
+        return dict(output=output, log=capture.messages, elapsed=elapsed)
+
+
+
+class _UnixQueryHandler(SocketServer.StreamRequestHandler):
+    # A JSON object per line, each answered with a JSON line
+    def handle(self):
+        for line in self.rfile:
+            try:
+                spec = json.loads(line)
+                if not isinstance(spec, dict):
+                    raise ValueError("not a JSON object")
+            except ValueError as e:
+                reply = dict(output=None, elapsed=0,
+                             log=[(logging.ERROR, "Invalid query: {}".format(e))])
+            else:
+                reply = self.server.run_query(spec)
+            self.wfile.write(json.dumps(reply) + b"\n")
+            self.wfile.flush()
+
+
+
+class _HTTPQueryHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # POST a JSON object to any path, get a JSON object back
+    def do_POST(self):
+        try:
+            spec = json.loads(self.rfile.read(
+                int(self.headers.getheader('Content-Length', 0))))
+            if not isinstance(spec, dict):
+                raise ValueError("not a JSON object")
+        except ValueError as e:
+            self.send_error(400, "Invalid query: {}".format(e))
+            return
+
+        body = json.dumps(self.server.run_query(spec))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', len(body))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, fmt, *args):
+        log.debug("%s - %s", self.address_string(), fmt % args)
+
+
+
+# Server classes are old-style, so the mixin can't go first
+class UnixQueryServer(SocketServer.UnixStreamServer, QueryServer):
+    pass
+
+
+
+class HTTPQueryServer(BaseHTTPServer.HTTPServer, QueryServer):
+    pass
+
+
+
+def parse_address(address):
+    '''Return (host, port) for "[host:]port", localhost by default,
+        or address itself as a Unix socket path
+    '''
+    match = re.match(r'^(?:([\w.-]+):)?(\d+)$', address)
+    if match:
+        return (match.group(1) or 'localhost', int(match.group(2)))
+    return address
+
+
+
+def serve(address, **options):
+    '''Serve queries on address, see parse_address(), until interrupted.
+        Options are SunlessSea() arguments. Return 1 if address is a path
+        to an existing file other than a socket, which is never removed,
+        or to a socket another server still accepts connections on
+    '''
+    address = parse_address(address)
+    created = None  # (device, inode) of the socket file created here
+    if isinstance(address, tuple):
+        server = HTTPQueryServer(address, _HTTPQueryHandler)
+    else:
+        if os.path.lexists(address):
+            if not stat.S_ISSOCK(os.lstat(address).st_mode):
+                log.error("Refusing to serve on %s: not a socket", address)
+                return 1
+            if _socket_live(address):
+                log.error("Refusing to serve on %s: a server is already"
+                          " running there", address)
+                return 1
+            os.remove(address)  # stale socket
+        server = UnixQueryServer(address, _UnixQueryHandler)
+        created = _file_id(address)
+
+    # Clean up on kill, not only on Ctrl+C
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+    try:
+        server.setup_ss(**options)
+        log.info("Serving queries on %s", address)
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if created and _file_id(address) == created:
+            os.remove(address)
+
+
+def _socket_live(path):
+    # Whether a server accepts connections on a Unix socket file. Only a
+    # refused connection means it is stale, so in doubt it is kept
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error as e:
+        return not e.errno == errno.ECONNREFUSED
+    finally:
+        sock.close()
+    return True
+
+
+def _file_id(path):
+    # Identity of a socket file, or None if path is not one
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return None
+    if not stat.S_ISSOCK(st.st_mode):
+        return None
+    return st.st_dev, st.st_ino
+
+
+
+def remote_query(address, spec):
+    '''Run a query on a server, see serve(). Logs its warnings and
+        errors locally, and returns its output
+    '''
+    address = parse_address(address)
+    body = json.dumps(spec)
+    if isinstance(address, tuple):
+        conn = httplib.HTTPConnection(*address)
+        try:
+            conn.request('POST', '/', body,
+                         {'Content-Type': 'application/json'})
+            response = conn.getresponse()
+            if not response.status == 200:
+                log.error("Server error %d: %s", response.status,
+                          response.reason)
+                return None
+            reply = json.loads(response.read())
+        finally:
+            conn.close()
+    else:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(address)
+            sock.sendall(body + b"\n")
+            sock.shutdown(socket.SHUT_WR)
+            reply = json.loads(sock.makefile().readline())
+        finally:
+            sock.close()
+
+    for level, message in reply['log']:
+        log.log(level, "%s", message)
+    log.debug("Query took %.3f seconds on server", reply['elapsed'])
+    return reply['output']
+
+
+
 def main(argv=None):
     global TEST_INTEGRITY
     args = parse_args(argv or [])
@@ -202,40 +1300,66 @@ def main(argv=None):
     log.debug(args)
     TEST_INTEGRITY = args.check
 
-    ss = SunlessSea(args.datadir)
+    if args.connect:
+        try:
+            output = remote_query(args.connect,
+                                  {_: getattr(args, _) for _ in QUERY_KEYS})
+        except (socket.error, httplib.HTTPException, ValueError) as e:
+            log.error("Could not query server at %s: %s", args.connect, e)
+            return 1
+        if output is not None:
+            safeprint(output)
+        return
+
+    options = dict(datadir=args.datadir, cachedir=args.cachedir,
+                   cache=args.cache, lazy=args.lazy, compact=args.compact,
+                   workers=args.workers, processes=args.processes,
+                   stream=args.stream, random_access=args.random_access)
+    # A single event is parsed alone, instead of loading them all
+    if (args.entity == 'events' and args.eid is not None and
+        not (args.method or args.batch or args.serve or args.diff or
+             args.export)):
+        options['random_access'] = True
+    if args.serve:
+        return serve(args.serve, **options)
+
+    if args.prettify:
+        prettify(args.datadir, args.prettify, args.workers)
+        return
 
-    log.debug(ss.locations)
-    log.debug(ss.qualities)
-    log.debug(ss.events)
-    log.debug(ss.shops)
+    if args.diff:
+        other = SunlessSea(**dict(options, datadir=args.diff))
+        for name, diff in SunlessSea(**options).diff(other).iteritems():
+            log.info("%s: %d added, %d removed, %d changed", name,
+                     len(diff.added), len(diff.removed), len(diff.changed))
+            for sign, entities in zip("+-~", diff):
+                for entity in entities:
+                    safeprint("{} {}".format(sign, entity.bare()))
+        return
 
-    if args.entity in ('locations', 'qualities', 'events', 'shops'):
-        entities = getattr(ss, args.entity).find(args.filter)
-        if not entities:
-            log.error("No %s found for %r", args.entity, args.filter)
-            return
-        if args.method == 'usage':
-            if not args.entity == 'qualities':
-                log.error("Method 'usage' only available for qualities")
-                return
-            safeprint(entities.usage(args.format))
-            return
+    ss = SunlessSea(**options)
 
-        if args.format == 'wiki':
-            safeprint(entities.wikitable())
-        elif args.format == 'wikipage':
-            safeprint(entities.wikipage())
-        elif args.format == 'pretty':
-            safeprint(entities.pretty())
-        elif args.format == 'dump':
-            safeprint(entities.dump())
-        else:
-            safeprint(entities.bare())
+    if args.export:
+        names = EXPORT_ENTITIES
+        if args.entity in EXPORT_ENTITIES:
+            names = (args.entity,)
+        export(ss, args.export, names, args.workers)
         return
 
-    elif args.entity == "autosave":
-        for _ in ss.autosave.qualities.find(args.filter):
-            safeprint(_)
+    if args.method == 'usage' or args.batch:
+        ss.preload('qualities', 'locations', 'events', 'shops')
+    elif args.entity in QUERY_ENTITIES:
+        ss.preload(args.entity)
+    elif args.entity == "demo":
+        ss.preload('events')
+
+    if args.batch:
+        batch(ss, args.batch, **{_: getattr(args, _) for _ in QUERY_KEYS})
+
+    elif args.entity in QUERY_ENTITIES:
+        output = iter_query(ss, **{_: getattr(args, _) for _ in QUERY_KEYS})
+        if output is not None:
+            safestream(output)
 
     elif args.entity == "demo":
         for event in ss.events.at(name="Pigmote Isle"):  # ID = 102804
@@ -274,9 +1398,13 @@ class Entity(object):
     _re_gamenote = re.compile('\[([^\]]+)]"?$')
     _re_adv = re.compile('\[(?P<key>[a-z]):(?P<value>(?:[^][]+|\[[^][]+])+)]')
 
+    __slots__ = ('_data', '_extra', 'idx', 'ss', 'id',
+                 'name', 'description', 'image')
+
 
     def __init__(self, data, idx=0, ss=None):
-        self._data = data
+        self._data  = data
+        self._extra = None  # What dump() can't rebuild, see _compact()
         self.idx   = idx
         self.ss    = ss
         self.id    = self._data['Id']
@@ -319,7 +1447,92 @@ class Entity(object):
 
 
     def dump(self):
-        return self._data
+        if self._data is not None:
+            return self._data
+
+        data = self._rebuild()
+        if self._extra:
+            overrides, absent = self._extra
+            data.update(overrides)
+            for key in absent:
+                del data[key]
+        return data
+
+
+    @classmethod
+    def dummy(cls, eid, ss=None, **data):
+        '''Placeholder for an entity missing in data files, shared by all
+            references to the same id
+        '''
+        key = (cls, eid)
+        if ss is None or key not in ss._dummies:
+            data['Id'] = eid
+            entity = cls(data=data, ss=ss)
+            if ss is not None:
+                ss._dummies[key] = entity
+            return entity
+
+        entity = ss._dummies[key]
+        ss._shared['dummies'] += 1
+        ss._shared['dummies_bytes'] += (sys.getsizeof(entity) +
+                                        sys.getsizeof(entity._data))
+        return entity
+
+
+    def _rebuild(self):
+        '''Rebuild raw data from attributes, for dump() after _compact()
+            Subclasses SHOULD extend to add their own fields
+        '''
+        return {
+            'Id':          self.id,
+            'Name':        self.name,
+            'Description': self.description,
+            'Image':       self.image,
+        }
+
+
+    def _children(self):
+        '''Entities created from parts of this entity's raw data'''
+        return ()
+
+
+    def _relink(self):
+        '''Resolve again references to entities of other containers, after
+            SunlessSea.reload() replaced them.
+            Subclasses SHOULD override if they hold any
+        '''
+        for child in self._children():
+            child._relink()
+
+
+    def _compact(self):
+        '''Drop the raw data to save memory, keeping only the bits dump()
+            can't rebuild from attributes. Children are compacted first
+        '''
+        if self._data is None:
+            return
+
+        for child in self._children():
+            child._compact()
+
+        data, rebuilt = self._data, self._rebuild()
+        overrides = {_: data[_] for _ in data
+                     if not (_ in rebuilt and same_data(rebuilt[_], data[_]))}
+        absent = tuple(_ for _ in rebuilt if _ not in data)
+        if overrides or absent:
+            self._extra = (overrides, absent)
+        self._data = None
+
+
+    def content_hash(self):
+        '''Stable hash of the entity's raw data, including its children.
+            Changes in linked entities, like an operator's quality, don't
+            change it
+        '''
+        return hashlib.sha1(json.dumps(self.dump(), sort_keys=True,
+                                       separators=(',', ':'),
+                                       ensure_ascii=False).encode('utf-8')
+                            ).hexdigest()
 
 
     def bare(self, sep='\t'):
@@ -374,6 +1587,71 @@ class Entity(object):
         return repr(text)[1:]
 
 
+    def _advanced_texts(self):
+        '''Strings that may contain [k:v] references, see _parse_adv()
+            Subclasses SHOULD extend if they have more of those
+        '''
+        return (self.name, self.description)
+
+
+    def _search_texts(self):
+        '''Strings searched by Entities.find(text=True)'''
+        return self._advanced_texts()
+
+
+    @classmethod
+    def _adv_qids(cls, text, ss=None):
+        '''Generate Quality IDs referenced as [q:ID] in an "Advanced" string,
+            including nested ones such as [d:[q:ID]]
+        '''
+        for node in cls._compile_adv(text, ss):
+            if type(node) is not tuple:
+                continue
+            key, value, parsed, _ = node
+            if key == 'q' and parsed is not None:
+                yield parsed
+            elif key == 'd':
+                for qid in cls._adv_qids(value, ss):
+                    yield qid
+
+
+    @classmethod
+    def _compile_adv(cls, text, ss=None):
+        '''Parse an "Advanced" string into a tuple of nodes, once per string
+            in the SunlessSea.adv_cache of ss, if any.
+            Nodes are either literal strings or (key, value, parsed, source)
+            tuples for [key:value] references, where parsed is the ID for
+            [q:ID], None for [q:NAME], and the nodes of value for [d:...]
+        '''
+        if '[' not in text:
+            return (text,) if text else ()
+
+        cache = getattr(ss, 'adv_cache', None)
+        nodes = cache.get(text) if cache is not None else None
+        if nodes is not None:
+            return nodes
+
+        nodes, pos = [], 0
+        for match in cls._re_adv.finditer(text):
+            if match.start() > pos:
+                nodes.append(text[pos:match.start()])
+            key, value = match.group('key', 'value')
+            parsed = None
+            if key == 'q' and value.isdigit():
+                parsed = int(value)
+            elif key == 'd':
+                parsed = cls._compile_adv(value, ss)
+            nodes.append((key, value, parsed, match.group()))
+            pos = match.end()
+        if pos < len(text):
+            nodes.append(text[pos:])
+
+        nodes = tuple(nodes)
+        if cache is not None:
+            cache[text] = nodes
+        return nodes
+
+
     def _parse_adv(self, text, qfmt="[{name}]", dfmt="[1 to {}]",
                    noqfmt="[Quality({})]", qnamefmt="{{{}}}"):
         '''
@@ -405,18 +1683,30 @@ class Entity(object):
                         is actually performed, '{}' for the name content.
         '''
 
-        result = text
-        for match in re.finditer(self._re_adv, text):
-            mstr, (key, value) = match.group(), match.group('key', 'value')
+        nodes = self._compile_adv(text, self.ss)
+        if all(type(_) is not tuple for _ in nodes):
+            return text
+        return self._render_adv(nodes, text, qfmt, dfmt, noqfmt, qnamefmt)
+
+
+    def _render_adv(self, nodes, text, qfmt, dfmt, noqfmt, qnamefmt):
+        # Single pass over nodes from _compile_adv(), see _parse_adv()
+        result = []
+        for node in nodes:
+            if type(node) is not tuple:
+                result.append(node)
+                continue
+
+            key, value, parsed, source = node
             subst = None
             quality = None
 
             # Qualities
             if key == 'q':
                 # By ID
-                if value.isdigit():
+                if parsed is not None:
                     if self.ss and self.ss.qualities:
-                        quality = self.ss.qualities.get(int(value))
+                        quality = self.ss.qualities.get(parsed)
                     if quality:
                         subst = format_obj(qfmt, quality, quality=quality)
                     else:
@@ -429,17 +1719,17 @@ class Entity(object):
 
             # Dice roll
             elif key == 'd':
-                subst = dfmt.format(self._parse_adv(value, qfmt, dfmt,
-                                                    noqfmt, qnamefmt))
+                subst = dfmt.format(self._render_adv(parsed, value, qfmt, dfmt,
+                                                     noqfmt, qnamefmt))
 
             else:
                 log.warn("Unknown %r key when parsing advanced string: %r",
                          key, text)
 
-            if subst:
-                result = result.replace(mstr, subst, 1)
+            # References rendered empty are left as they are
+            result.append(subst or source)
 
-        return result
+        return "".join(result)
 
 
     def __repr__(self):
@@ -503,21 +1793,28 @@ class Quality(Entity):
         ('image_status',  'LevelImageText', 'Images'),
     )
 
+    _typed_fields = (
+        ("AvailableAt",        str,  ""),
+        ("Cap",                int,  0),
+        ("Category",           int,  0),
+        ("DifficultyScaler",   int,  0),
+        ("DifficultyTestType", int,  0),
+        ("IsSlot",             bool, False),
+        ("Nature",             int,  0),
+        ("Persistent",         bool, False),
+        ("Tag",                str,  ""),
+        ("Visible",            bool, False),
+    )
+
+    __slots__ = ('availableat', 'cap', 'category', 'difficultyscaler',
+                 'difficultytesttype', 'isslot', 'nature', 'persistent',
+                 'tag', 'visible',
+                 'level_status', 'change_status', 'image_status')
+
 
     def __init__(self, data, idx=0, ss=None):
         super(Quality, self).__init__(data=data, idx=idx, ss=ss)
-        for attr, atype, default in (
-            ("AvailableAt",        str,  ""),
-            ("Cap",                int,  0),
-            ("Category",           int,  0),
-            ("DifficultyScaler",   int,  0),
-            ("DifficultyTestType", int,  0),
-            ("IsSlot",             bool, False),
-            ("Nature",             int,  0),
-            ("Persistent",         bool, False),
-            ("Tag",                str,  ""),
-            ("Visible",            bool, False),
-        ):
+        for attr, atype, default in self._typed_fields:
             setattr(self, attr.lower(), atype(self._data.get(attr, default)))
 
         for attr, key, _ in self._status_fields:
@@ -530,6 +1827,17 @@ class Quality(Entity):
         return {int(k):v for k,v in (row.split("|") for row in value.split("~"))}
 
 
+    def _rebuild(self):
+        data = super(Quality, self)._rebuild()
+        for attr, atype, _ in self._typed_fields:
+            value = getattr(self, attr.lower())
+            data[attr] = unicode(value) if atype is str else value
+        for attr, key, _ in self._status_fields:
+            data[key] = "~".join("{}|{}".format(*_) for _ in
+                                 sorted(getattr(self, attr).iteritems()))
+        return data
+
+
     def pretty(self):
         pretty = super(Quality, self).pretty()
 
@@ -543,6 +1851,32 @@ class Quality(Entity):
         return pretty
 
 
+    def references(self, advanced=False):
+        '''
+        All Requirements, Effects and Shop Items referencing this quality,
+        as a list of (parents..., item) tuples, such as:
+            (Event, Requirement)
+            (Event, Effect)
+            (Event, Action, Requirement)
+            (Event, Action, Outcome, Effect)
+            (Shop, ShopItem)
+
+        If advanced, also include all entities mentioning it as [q:ID] in
+        their Advanced operators, names, descriptions or messages, such as:
+            (Event, Action, Requirement)  # MinAdvanced="[q:ID] + 1"
+            (Event, Action)               # Name="Pay [q:ID] echoes"
+            (Location,)
+        '''
+        references = self.ss.references.get(self.id, [])
+        if advanced:
+            # Both lists are in walk order, keep it across them
+            order = ('Quality', 'Location', 'Event', 'Shop')
+            references = sorted(
+                references + self.ss.advanced_references.get(self.id, []),
+                key=lambda _: (order.index(_[0].etype), _[0].idx))
+        return references
+
+
     def usage(self, formatting='pretty'):
         '''
         Shows all usages, that is: all events, actions, outcomes and shops
@@ -555,42 +1889,37 @@ class Quality(Entity):
         if not formatting == 'pretty':
             log.info("You don't want pretty, but that's what you'll get")
 
-        qid = self.id
-        results = {}
+        results = collections.OrderedDict()
         output = []
-        for e in self.ss.events:
-            for r in e.requirements:
-                if r.quality.id == qid:
-                    results.setdefault(e,
-                        dict(req=None, eff=None, act={}))['req'] = r
-                    break
 
-            for f in e.effects:
-                if r.quality.id == qid:
-                    results.setdefault(e,
-                        dict(req=None, eff=None, act={}))['eff'] = f
-                    break
+        def _add(items, item):
+            if item not in items:
+                items.append(item)
 
-            for a in e.actions:
-                for r in a.requirements:
-                    if r.quality.id == qid:
-                        results.setdefault(e,
-                            dict(req=None, eff=None, act={}))['act'].setdefault(a,
-                                dict(req=None, out=[]))['req'] = r
-                        break
+        for ref in self.references(advanced=True):
+            e, i = ref[0], ref[-1]
 
-                for o in a.outcomes:
-                    for f in o.effects:
-                        if f.quality.id == qid:
-                            results.setdefault(e,
-                                dict(req=None, eff=None, act={}))['act'].setdefault(a,
-                                    dict(req=None, out=[]))['out'].append(o)
-                            break
+            # Shops, and Qualities and Locations mentioning it
+            if not e.etype == "Event":
+                items = results.setdefault(e, [])
+                if len(ref) > 1:
+                    _add(items, i)
+                continue
 
-        for s in self.ss.shops:
-            for i in s.items:
-                if qid in (i.item.id, i.currency.id):
-                    results.setdefault(s, []).append(i)
+            r = results.setdefault(e, dict(req=[], eff=[],
+                                           act=collections.OrderedDict()))
+            if len(ref) == 1:
+                continue
+
+            if len(ref) == 2 and not i.etype == "Action":
+                _add(r['req' if i.etype == "Requirement" else 'eff'], i)
+                continue
+
+            a = r['act'].setdefault(ref[1], dict(req=[], out=[]))
+            if i.etype == "Requirement":
+                _add(a['req'], i)
+            elif len(ref) > 2:
+                _add(a['out'], ref[2])
 
         def _print(e, i=0):
             if not e:  # No object (None) or blank line ("")
@@ -619,20 +1948,21 @@ class Quality(Entity):
             output.append(indent(out, i))
 
 
-        for e, r in sorted(results.iteritems()):
+        for e, r in results.iteritems():
             _print(e)
 
-            if e.etype == "Shop":
+            if not e.etype == "Event":
                 for i in r:
                     _print(i, 1)
                 _print("")
                 continue
 
-            _print(r['req'], 1)
-            _print(r['eff'], 1)
+            for i in r['req'] + r['eff']:
+                _print(i, 1)
             for a in r['act']:
                 _print(a, 1)
-                _print(r['act'][a]['req'], 2)
+                for i in r['act'][a]['req']:
+                    _print(i, 2)
                 for o in r['act'][a]['out']:
                     _print(o, 2)
                 _print("")
@@ -646,6 +1976,8 @@ class Location(Entity):
     _REQUIRED_FIELDS = set(('Name',))
     _OPTIONAL_FIELDS = set(('Description', 'ImageName', 'MoveMessage'))
 
+    __slots__ = ('message', 'setting')
+
 
     def __init__(self, data, idx=0, ss=None):
         super(Location, self).__init__(data=data, idx=idx, ss=ss)
@@ -653,6 +1985,17 @@ class Location(Entity):
         self.setting = 0
 
 
+    def _advanced_texts(self):
+        return super(Location, self)._advanced_texts() + (self.message,)
+
+
+    def _rebuild(self):
+        data = super(Location, self)._rebuild()
+        data['ImageName']   = data.pop('Image')
+        data['MoveMessage'] = self.message
+        return data
+
+
     def pretty(self):
         pretty = super(Location, self).pretty().strip()  # No '\n' after Description
         if self.message:
@@ -666,6 +2009,8 @@ class ShopItem(Entity):
     _OPTIONAL_FIELDS = set(("Cost", "SellPrice"))
     _IGNORED_FIELDS  = set(("BuyMessage", "SellMessage"))  # only dummies
 
+    __slots__ = ('shop', 'item', 'currency', 'buy', 'sell')
+
 
     def __init__(self, data, idx=0, ss=None, shop=None):
         super(ShopItem, self).__init__(data=data, idx=idx, ss=ss)
@@ -676,6 +2021,21 @@ class ShopItem(Entity):
         self.sell     = self._data.get('SellPrice', 0)
 
 
+    def _rebuild(self):
+        data = super(ShopItem, self)._rebuild()
+        data['Quality']         = {'Id': getattr(self.item, 'id', None)}
+        data['PurchaseQuality'] = {'Id': getattr(self.currency, 'id', None)}
+        data['Cost']            = self.buy
+        data['SellPrice']       = self.sell
+        return data
+
+
+    def _relink(self):
+        data = self.dump()
+        self.item     = self.ss.qualities.get(data['Quality']['Id'])
+        self.currency = self.ss.qualities.get(data['PurchaseQuality']['Id'])
+
+
     def pretty(self):
         sell = ", sell for {}".format(self.sell) if self.sell else ""
         return "{0.item}: {0.buy} x {0.currency}{sell}".format(self, sell=sell)
@@ -700,15 +2060,34 @@ class Shop(Entity):
     _REQUIRED_FIELDS = Entity._REQUIRED_FIELDS | set(('Availabilities',))
     _IGNORED_FIELDS  = {'Ordering'}  # a single occurrence
 
+    __slots__ = ('locations', 'settings', 'items')
+
 
-    def __init__(self, data, idx=0, ss=None, locations=None):
+    def __init__(self, data, idx=0, ss=None, locations=None, settings=()):
         super(Shop, self).__init__(data=data, idx=idx, ss=ss)
         self.locations = locations
+        self.settings  = settings  # Setting IDs of its exchange
         self.items = [ShopItem(data=_d, idx=_i, ss=self.ss, shop=self)
                       for _i, _d in
                       enumerate(self._data['Availabilities'], 1)]
 
 
+    def _rebuild(self):
+        data = super(Shop, self)._rebuild()
+        data['Availabilities'] = [_.dump() for _ in self.items]
+        return data
+
+
+    def _children(self):
+        return self.items
+
+
+    def _relink(self):
+        super(Shop, self)._relink()
+        self.locations = set(_l for _ in self.settings if _ in self.ss.settings
+                             for _l in self.ss.settings[_]['locations'])
+
+
     def pretty(self):
         pretty = super(Shop, self).pretty()
         locations = (
@@ -741,6 +2120,8 @@ class QualityOperator(Entity):
 
     _reverse = (r'Terror$', r'Hunger$', r'Menaces:')
 
+    __slots__ = ('parent', 'quality', 'operator')
+
 
     def __init__(self, data, idx=0, parent=None, ss=None):
         super(QualityOperator, self).__init__(data=data, idx=idx, ss=ss)
@@ -755,9 +2136,7 @@ class QualityOperator(Entity):
             self.quality = self.ss.qualities.get(qid)
 
         if not self.quality:
-            # Create a dummy one
-            self.quality = Quality(data={'Id': qid, 'Name':''},
-                                   ss=self.ss)
+            self.quality = Quality.dummy(qid, ss=self.ss, Name='')
             log.warning("Could not find Quality for %r: %d",
                         parent, qid)
 
@@ -769,6 +2148,27 @@ class QualityOperator(Entity):
                          self.parent, self)
 
 
+    def _advanced_texts(self):
+        return tuple(unicode(self.operator[_]) for _ in self.operator
+                     if 'Advanced' in _)
+
+
+    def _rebuild(self):
+        data = super(QualityOperator, self)._rebuild()
+        data.update(self.operator)
+        data['AssociatedQuality'] = {'Id': self.quality.id}
+        return data
+
+
+    def _relink(self):
+        qid = self.quality.id
+        self.quality = self.ss.qualities.get(qid)
+        if not self.quality:
+            self.quality = Quality.dummy(qid, ss=self.ss, Name='')
+            log.warning("Could not find Quality for %r: %d",
+                        self.parent, qid)
+
+
     def pretty(self):
         return self._format()
 
@@ -784,7 +2184,33 @@ class QualityOperator(Entity):
         )
 
 
-    def _format(self,
+    def _format(self, *args, **kwargs):
+        '''Render with _render(), cached in SunlessSea.render_cache by
+            operator, format arguments and names of involved qualities
+        '''
+        cache = getattr(self.ss, 'render_cache', None)
+        if cache is None:
+            return self._render(*args, **kwargs)
+
+        # Same keyword arguments in another order are just a miss
+        key = (self, args, tuple(kwargs.iteritems()), self._quality_names())
+        text = cache.get(key)
+        if text is None:
+            text = cache[key] = self._render(*args, **kwargs)
+        return text
+
+
+    def _quality_names(self):
+        '''Names of the quality and those in Advanced operators'''
+        names = [self.quality.name]
+        for text in self._advanced_texts():
+            for qid in self._adv_qids(text, self.ss):
+                quality = self.ss.qualities.get(qid)
+                names.append(quality and quality.name)
+        return tuple(names)
+
+
+    def _render(self,
             # Defaults are suitable for __unicode__() and pretty()
             qfmt="{name}{sep}{ops}{ifsep}{ifs}",
             qfmtqty="{name} += {qtyops}{ifsep}{ifs}",
@@ -910,6 +2336,8 @@ class Effect(QualityOperator):
     )
     _OPTIONAL_FIELDS = QualityOperator._OPTIONAL_FIELDS | set(_OPS)
 
+    __slots__ = ()
+
 
     def __init__(self, data, idx=0, parent=None, ss=None):
         super(Effect, self).__init__(data=data, idx=idx, parent=parent, ss=ss)
@@ -935,6 +2363,8 @@ class Requirement(QualityOperator):
     )
     _OPTIONAL_FIELDS = QualityOperator._OPTIONAL_FIELDS | set(_OPS)
 
+    __slots__ = ()
+
 
     def wiki(self):
         return self._format(
@@ -949,7 +2379,7 @@ class Requirement(QualityOperator):
         )
 
 
-    def _format(self,
+    def _render(self,
             # Defaults are suitable for __unicode__()
             fmt="{quality}{sep}{ops}",
             fmtcha="{quality} challenge ({} for 100%){opsep}{ops}",
@@ -1060,6 +2490,12 @@ class BaseEvent(Entity):
         effects=     ('QualitiesAffected', Effect),       # Events and Outcomes
     )
 
+    # Children created only on first access in lazy mode.
+    # Subclasses SHOULD override, with a lazyslot for each
+    _LAZY_ATTRS = ()
+
+    __slots__ = ('parent',)
+
 
     def __init__(self, data, idx=0, parent=None, ss=None):
         super(BaseEvent, self).__init__(data=data, idx=idx, ss=ss)
@@ -1067,6 +2503,9 @@ class BaseEvent(Entity):
         # Only Actions and Outcomes
         self.parent = parent
 
+        for attr in self._LAZY_ATTRS:
+            setattr(self, '_' + attr, None)
+
         # Integrity checks
         if not TEST_INTEGRITY:
             return
@@ -1087,9 +2526,10 @@ class BaseEvent(Entity):
             pretty += "\n\tLocation: {}".format(self.location)
 
         if getattr(self, 'requirements', None):
-            pretty += "\n\tRequirements: {:d}\n".format(len(self.requirements))
-            for item in self.requirements:
-                pretty += "{}\n".format(indent(item.pretty(), 2))
+            pretty += "\n\tRequirements: {:d}\n{}".format(
+                len(self.requirements),
+                "".join("{}\n".format(indent(item.pretty(), 2))
+                        for item in self.requirements))
 
         return pretty
 
@@ -1112,6 +2552,39 @@ class BaseEvent(Entity):
         return "\n".join(out)
 
 
+    def _create_lazy(self):
+        '''Create all children now, unless in lazy mode
+            Subclasses MUST call this at the end of their __init__()
+        '''
+        if self.ss and self.ss.lazy:
+            return
+        for attr in self._LAZY_ATTRS:
+            getattr(self, attr)
+
+
+    def _children(self):
+        for attr in self._LAZY_ATTRS:
+            for child in getattr(self, attr):
+                yield child
+
+
+    def _relink(self):
+        # Children not yet created will link to the new entities anyway
+        for attr in self._LAZY_ATTRS:
+            for child in getattr(self, '_' + attr) or ():
+                child._relink()
+
+
+    @lazyslot
+    def requirements(self):
+        return list(self._create_qualops('requirements'))
+
+
+    @lazyslot
+    def effects(self):
+        return list(self._create_qualops('effects'))
+
+
     def _create_qualops(self, attr):
         key, cls = self._qualop_types[attr]
         iids = []  # needed just for the integrity check
@@ -1153,6 +2626,11 @@ class Event(BaseEvent):
         "Urgency",
     ))
 
+    _LAZY_ATTRS = ('requirements', 'effects', 'actions')
+
+    __slots__ = ('autofire', 'category', 'location',
+                 '_requirements', '_effects', '_actions')
+
 
     def __init__(self, data, idx=0, ss=None):
         super(Event, self).__init__(data=data, idx=idx, ss=ss)
@@ -1168,14 +2646,49 @@ class Event(BaseEvent):
 
             if not self.location:
                 log.warning("Could not find Location for %r: %d", self, iid)
-                self.location = Location(self._data['LimitedToArea'])
+                self.location = Location.dummy(
+                    iid, ss=self.ss, **self._data['LimitedToArea'])
+
+        self._create_lazy()
+
+
+    def _search_texts(self):
+        texts = list(super(Event, self)._search_texts())
+        for action in self.actions:
+            texts.extend(action._search_texts())
+            for outcome in action.outcomes:
+                texts.extend(outcome._search_texts())
+        return texts
+
+
+    def _rebuild(self):
+        data = super(Event, self)._rebuild()
+        data['Autofire'] = self.autofire
+        data['Category'] = self.category
+        if self.location:
+            data['LimitedToArea'] = {'Id': self.location.id}
+        data['QualitiesRequired'] = [_.dump() for _ in self.requirements]
+        data['QualitiesAffected'] = [_.dump() for _ in self.effects]
+        data['ChildBranches']     = [_.dump() for _ in self.actions]
+        return data
+
+
+    def _relink(self):
+        super(Event, self)._relink()
+        if self.location:
+            lid = self.location.id
+            self.location = self.ss.locations.get(lid)
+            if not self.location:
+                log.warning("Could not find Location for %r: %d", self, lid)
+                self.location = Location.dummy(
+                    lid, ss=self.ss, **self.dump()['LimitedToArea'])
 
-        self.requirements = list(self._create_qualops('requirements'))
-        self.effects      = list(self._create_qualops('effects'))
 
-        self.actions = []
-        for i, item in enumerate(self._data.get('ChildBranches', []), 1):
-            self.actions.append(Action(data=item, idx=i, parent=self, ss=self.ss))
+    @lazyslot
+    def actions(self):
+        return [Action(data=item, idx=i, parent=self, ss=self.ss)
+                for i, item in enumerate(self._data.get('ChildBranches', []),
+                                         1)]
 
 
     def pretty(self, short=False):
@@ -1283,24 +2796,40 @@ class Action(BaseEvent):
                                ("Success", "Successful"))
     _outcome_label_failed   = (("Default", "Failed"),)
 
+    _LAZY_ATTRS = ('requirements', 'outcomes')
+
+    __slots__ = ('canfail', '_requirements', '_outcomes')
+
 
     def __init__(self, data, idx=0, parent=None, ss=None):
         super(Action, self).__init__(data=data, idx=idx, parent=parent, ss=ss)
 
-        self.requirements = list(self._create_qualops('requirements'))
-        self.canfail      = 'SuccessEvent' in self._data
+        self.canfail = 'SuccessEvent' in self._data
+
+        self._create_lazy()
+
+
+    def _rebuild(self):
+        data = super(Action, self)._rebuild()
+        data['QualitiesRequired'] = [_.dump() for _ in self.requirements]
+        for outcome in self.outcomes:
+            data[outcome.type] = outcome.dump()
+            if outcome.chance is not None:
+                data[outcome.type + 'Chance'] = outcome.chance
+        return data
 
-        self.outcomes = []
-        for i, item in enumerate((_ for _ in self._OUTCOME_TYPES
-                                  if _ in self._data), 1):
-            self.outcomes.append(Outcome(
-                 data      = self._data[item],
-                 idx       = i,
-                 parent    = self,
-                 ss        = self.ss,
-                 otype     = item,
-                 chance    = self._data.get(item + 'Chance', None),
-                 label     = self._outcome_label(item)))
+
+    @lazyslot
+    def outcomes(self):
+        return [Outcome(data   = self._data[item],
+                        idx    = i,
+                        parent = self,
+                        ss     = self.ss,
+                        otype  = item,
+                        chance = self._data.get(item + 'Chance', None),
+                        label  = self.ss.intern(self._outcome_label(item)))
+                for i, item in enumerate((_ for _ in self._OUTCOME_TYPES
+                                          if _ in self._data), 1)]
 
 
     @property
@@ -1312,12 +2841,9 @@ class Action(BaseEvent):
 
 
     def pretty(self):
-        pretty = super(Action, self).pretty().strip()
-
-        for item in self.outcomes:
-            pretty += "\n\n{}".format(indent(item.pretty(), 1))
-
-        return pretty
+        pretty = [super(Action, self).pretty().strip()]
+        pretty.extend(indent(item.pretty(), 1) for item in self.outcomes)
+        return "\n\n".join(pretty)
 
 
     def wikirow(self):
@@ -1367,13 +2893,10 @@ class Action(BaseEvent):
             firstrow=firstrow,
         )
 
-        page += secondrow
-
-        for outcome in self.outcomes[1:]:
-            page += "|-\n{}|-\n{}".format(innerheader(outcome),
-                                            innercell(outcome))
-
-        return page
+        return "".join([page, secondrow] +
+                       ["|-\n{}|-\n{}".format(innerheader(outcome),
+                                              innercell(outcome))
+                        for outcome in self.outcomes[1:]])
 
 
     def _outcome_label(self, otype):
@@ -1402,6 +2925,10 @@ class Outcome(BaseEvent):
         "SwitchToSettingId",
     ))
 
+    _LAZY_ATTRS = ('effects',)
+
+    __slots__ = ('type', 'chance', 'label', '_trigger', '_effects')
+
 
     def __init__(self, data, idx=0, parent=None, ss=None,
                  otype=None, chance=None, label=None):
@@ -1410,8 +2937,42 @@ class Outcome(BaseEvent):
         self.type    = otype
         self.chance  = chance
         self.label   = label
-        self.trigger = self._data.get('LinkToEvent', {}).get('Id', None)
-        self.effects = list(self._create_qualops('effects'))
+
+        # 'LinkToEvent' reference, an Event ID until first accessed
+        self._trigger = self._data.get('LinkToEvent', {}).get('Id', None)
+
+        self._create_lazy()
+
+
+    def _rebuild(self):
+        data = super(Outcome, self)._rebuild()
+        data['QualitiesAffected'] = [_.dump() for _ in self.effects]
+        if self._trigger:
+            data['LinkToEvent'] = {'Id': getattr(self._trigger, 'id',
+                                                 self._trigger)}
+        return data
+
+
+    def _relink(self):
+        super(Outcome, self)._relink()
+        if self._trigger is not None and type(self._trigger) is not int:
+            self._trigger = self._trigger.id  # resolved again on access
+
+
+    @property
+    def trigger(self):
+        if type(self._trigger) is not int:
+            return self._trigger
+
+        trigger = self._trigger
+        self._trigger = self.ss.events.get(trigger)
+        if not self._trigger:
+            self._trigger = Event.dummy(trigger, ss=self.ss,
+                                        ChildBranches=[],
+                                        QualitiesRequired=[])
+            log.error("%r.%r.%r links to a non-existant event: %d",
+                      self.parent.parent, self.parent, self, trigger)
+        return self._trigger
 
 
     def pretty(self, short=False):
@@ -1457,19 +3018,96 @@ class Outcome(BaseEvent):
 
 
 
+class Index(object):
+    '''Hash index of a container's entities, see Entities.index_on()
+
+        Indexes of derived containers, such as the ones from find(), reuse
+        the index of their base container, only filtering each lookup
+    '''
+
+    def __init__(self, entities, key, multi=False, parent=None):
+        self.entities = entities
+        self.key      = key
+        self.multi    = multi
+        self.parent   = parent
+        self._index   = None
+
+        if parent:
+            return
+
+        getkey = key if callable(key) else operator.attrgetter(key)
+        self._index = {}
+        for entity in entities:
+            for value in (getkey(entity) if multi else (getkey(entity),)):
+                self._index.setdefault(value, []).append(entity)
+
+
+    def lookup(self, value):
+        '''Return entities with that key value, as a container view'''
+        return self.entities._derive(subset=self._bucket(value))
+
+
+    def keys(self):
+        if not self.parent:
+            return self._index.keys()
+        return [_ for _ in self.parent.keys() if self._bucket(_)]
+
+
+    def _bucket(self, value):
+        if not self.parent:
+            return self._index.get(value, [])
+        if not self.entities._ordered():
+            bucket = set(self.parent._bucket(value))
+            return [_ for _ in self.entities if _ in bucket]
+        return [_ for _ in self.parent._bucket(value)
+                if self.entities.get(_.id) is _]
+
+
+    def __contains__(self, value):
+        return bool(self._bucket(value))
+
+
+    def __len__(self):
+        return len(self.keys())
+
+
+
+EntitiesDiff = collections.namedtuple('EntitiesDiff', 'added removed changed')
+
+
+
 class Entities(object):
-    '''Base class for entity containers. Subclasses SHOULD override EntityCls!'''
+    '''Base class for entity containers. Subclasses SHOULD override EntityCls!
+
+        Containers returned by find(), at(), slicing and index lookups are
+        views: they only reference the container they came from, and are
+        evaluated on iteration, so chaining them copies nothing.
+        See _derive() for details
+    '''
     EntityCls=Entity
 
 
     def __init__(self, data=None, entities=None, path=None, ss=None,
-                 *eargs, **ekwargs):
+                 base=None, view=None, offsets=None, *eargs, **ekwargs):
         self._entities = {}
         self._order = []
+        self._indexes = {}
+        self._searched = set()  # find() modes used, see find()
+        self._base = base or self  # container this one was derived from
+        self._view = view  # (source, subset, predicate, window), if a view
+        self._offsets = offsets  # {id: (idx, offset, length)} in path
+        self._mmap = None  # of path, for _parse_entity()
+        self._merkle = None  # see _merkle_tree()
         self.path = path
         self.ss = ss
 
-        if entities is None:
+        if view is not None:
+            # Created by _materialize(), if ever needed
+            self._entities = self._order = None
+        elif offsets is not None:
+            # Entities parsed one by one by get(), or all by _materialize()
+            self._order = None
+        elif entities is None:
             for idx, edata in enumerate(data, 1):
                 entity = self.EntityCls(data=edata, idx=idx, ss=self.ss,
                                         *eargs, **ekwargs)
@@ -1481,42 +3119,321 @@ class Entities(object):
                 self._order.append(entity)
 
 
-    def find(self, name):
+    def index_on(self, key, multi=False):
+        '''Return an Index of the entities by key, an entity attribute name
+            or a function of an entity. If multi, key yields several values
+            for each entity. Indexes are cached, and shared by derived
+            containers, so prefer a named function over a lambda.
+
+            Example: ss.events.index_on('category').lookup(2)
+        '''
+        index = self._indexes.get((key, multi))
+        if index is None:
+            index = Index(self, key, multi,
+                          parent=(self._base.index_on(key, multi)
+                                  if self._base is not self else None))
+            self._indexes[(key, multi)] = index
+        return index
+
+
+    def find(self, name, text=False):
         '''Return Entities filtered by name, case-insensitive.
+            If text, also search descriptions, messages and the texts of
+            event actions and outcomes.
             If falsy, return all entities
+
+            Candidates are pruned by a trigram index before the regular
+            expression is tried. The index is only built on the second
+            search in each mode, so one-off searches do not pay for it
         '''
         if not name:
             return self
-        return self.__class__(path=self.path,
-                              ss=self.ss,
-                              entities=(_ for _ in self
-                                        if re.search(name, _.name,
-                                                     re.IGNORECASE)))
+
+        regex = re.compile(name, re.IGNORECASE)
+        if text:
+            texts, key = (lambda _: _._search_texts()), self._text_trigrams
+        else:
+            texts, key = (lambda _: (_.name,)), self._name_trigrams
+
+        candidates = self
+        required = regex_trigrams(name)
+        if required and key in self._base._searched:
+            index = self.index_on(key, multi=True)
+            candidates = min((index._bucket(_) for _ in required), key=len)
+        self._base._searched.add(key)
+
+        return self._derive(subset=candidates,
+                            predicate=lambda _: any(regex.search(_t)
+                                                    for _t in texts(_)))
+
+
+    @staticmethod
+    def _name_trigrams(entity):
+        return trigrams(entity.name)
+
+
+    @staticmethod
+    def _text_trigrams(entity):
+        return set().union(*(trigrams(_) for _ in entity._search_texts()))
+
+
+    def at(self, lid=0, name=""):
+        '''Return entities by location ID or name'''
+        index = self.index_on(self._entity_locations, multi=True)
+        # Only search locations that actually have entities in base
+        candidates = self._base.index_on(self._entity_locations,
+                                         multi=True).keys
+        locations = set()
+        if lid:
+            location = self.ss and self.ss.locations.get(lid)
+            if location and location in index:
+                locations.add(location)
+            else:
+                # Dummy locations, not in ss.locations
+                locations.update(_ for _ in candidates() if _.id == lid)
+        if name:
+            locations.update(_ for _ in candidates()
+                             if re.search(name, _.name, re.IGNORECASE))
+
+        entities = [_ for location in locations
+                    for _ in index._bucket(location)]
+        if len(locations) > 1:
+            entities = sorted(set(entities), key=lambda _: _.idx)
+            if not self._ordered():
+                entities = None
+
+        return self._derive(subset=entities,
+                            predicate=lambda _: not locations.isdisjoint(
+                                self._entity_locations(_)))
+
+
+    @staticmethod
+    def _entity_locations(entity):
+        '''Locations an entity is tied to, for at()
+            Subclasses with such entities SHOULD override
+        '''
+        return ()
+
+
+    def hashes(self):
+        '''Content hash of each entity by ID, see Entity.content_hash().
+            Computed once, in the base container
+        '''
+        if self._base is not self:
+            hashes = self._base.hashes()
+            return {_.id: hashes[_.id] for _ in self}
+        hashes = {}
+        for _, bucket in self._merkle_tree()[1]:
+            hashes.update(bucket)
+        return hashes
+
+
+    def digest(self):
+        '''Digest of all entities' content hashes, equal for containers
+            with the same entities
+        '''
+        return self._merkle_tree()[0]
+
+
+    def diff(self, other):
+        '''Compare with another container of the same type, usually from
+            another game version. Return an EntitiesDiff of entities added
+            and changed in other, and removed from this one.
+            Only entities in buckets with different digests are compared
+        '''
+        mine, theirs = self._merkle_tree(), other._merkle_tree()
+        added, removed, changed = [], [], []
+        if not mine[0] == theirs[0]:
+            for (digest, bucket), (odigest, obucket) in zip(mine[1],
+                                                            theirs[1]):
+                if digest == odigest:
+                    continue
+                for eid, ehash in bucket.iteritems():
+                    if eid not in obucket:
+                        removed.append(self.get(eid))
+                    elif not obucket[eid] == ehash:
+                        changed.append(other.get(eid))
+                added.extend(other.get(_) for _ in obucket if _ not in bucket)
+        key = operator.attrgetter('id')
+        return EntitiesDiff(sorted(added, key=key), sorted(removed, key=key),
+                            sorted(changed, key=key))
+
+
+    _MERKLE_BUCKETS = 256
+
+    def _merkle_tree(self):
+        '''(root digest, [(digest, {id: content hash})...]), with entities
+            in buckets by ID, so diff() compares only changed buckets
+        '''
+        if self._merkle is None:
+            if self._base is self:
+                hashes = ((_.id, _.content_hash()) for _ in self)
+            else:
+                hashes = self.hashes().iteritems()
+            buckets = [{} for _ in xrange(self._MERKLE_BUCKETS)]
+            for eid, ehash in hashes:
+                buckets[hash(eid) % self._MERKLE_BUCKETS][eid] = ehash
+            digests = [hashlib.sha1("".join("{}:{}\n".format(*_) for _ in
+                                            sorted(bucket.iteritems()))
+                                    ).hexdigest()
+                       for bucket in buckets]
+            self._merkle = (hashlib.sha1("".join(digests)).hexdigest(),
+                            zip(digests, buckets))
+        return self._merkle
+
+
+    def _derive(self, subset=None, predicate=None, window=None):
+        '''Return a view of a subset of entities from this container
+
+            subset:    Sequence of entities from this container, in order.
+                        With a predicate, may also contain non-matching
+                        ones, as just a pre-filtered list of candidates.
+            predicate: Function selecting entities. Allows get() without
+                        evaluating the view.
+            window:    Slice of this container entities
+        '''
+        return self.__class__(path=self.path, ss=self.ss, base=self._base,
+                              view=(self, subset, predicate, window))
+
+
+    def _ordered(self):
+        '''Return True if entities are in the same order as in the base
+            container, so in 'idx' order, as in any index bucket
+        '''
+        if self._view is None:
+            return True
+        source, _, _, window = self._view
+        return (window is None or window.indices(0)[2] > 0) and source._ordered()
+
+
+    def _iter_view(self):
+        source, subset, predicate, window = self._view
+
+        if window is not None:
+            order = source._materialize()
+            subset = (order[_] for _ in xrange(*window.indices(len(order))))
+        elif subset is None:
+            subset = source
+
+        for entity in subset:
+            if predicate is None or predicate(entity):
+                yield entity
+
+
+    def _materialize(self):
+        '''Evaluate a view, if not done already. Return its entities list'''
+        if self._order is None and self._view is None:
+            self._parse_all()
+        elif self._order is None:
+            self._order = list(self._iter_view())
+            self._entities = {_.id: _ for _ in self._order}
+        return self._order
+
+
+    def _parse_entity(self, eid):
+        '''Parse a single entity at its offset in the data file.
+            Return None if not there
+        '''
+        if eid not in self._offsets:
+            return None
+        idx, offset, length = self._offsets[eid]
+        if self._mmap is None:
+            with open(self.path, 'rb') as fd:
+                self._mmap = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        data = json_decoder(intern=self.ss.intern).decode(
+            self._mmap[offset:offset + length])
+        entity = self._entities[eid] = self._create_entity(data, idx)
+        return entity
+
+
+    def _parse_all(self):
+        # Entities already parsed by get() are kept
+        log.debug("Parsing all entities in %s", self.path)
+        self._order = []
+        for idx, data in enumerate(iter_json(self.path,
+                                             intern=self.ss.intern), 1):
+            entity = self._entities.get(data['Id'])
+            if entity is None:
+                entity = self._entities[data['Id']] = self._create_entity(
+                    data, idx)
+            self._order.append(entity)
+        self._offsets = None
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+
+    def _create_entity(self, data, idx):
+        entity = self.EntityCls(data=data, idx=idx, ss=self.ss)
+        if self.ss.compact:
+            entity._compact()
+        return entity
+
+
+    def _parsed(self):
+        '''Entities created so far, without parsing any in random access'''
+        if self._order is None and self._view is None:
+            return self._entities.values()
+        return self._materialize()
+
+
+    def __getstate__(self):
+        # Indexes are rebuilt on demand, and may hold unpicklable functions
+        self._materialize()
+        state = self.__dict__.copy()
+        state['_indexes'] = {}
+        state['_searched'] = set()
+        state['_view'] = None
+        state['_mmap'] = None
+        return state
 
 
     def wikitable(self):
-        table = ('{| class="ss-table sortable" style="width: 100%;"\n'
+        return "".join(self.iter_wikitable())
+
+
+    def wikipage(self):
+        return "".join(self.iter_wikipage())
+
+
+    def dump(self):
+        return [_.dump() for _ in self]
+
+
+    def pretty(self):
+        return "".join(self.iter_pretty())
+
+
+    # Streaming renderers, generating the output of the methods above (and
+    # unicode() of dump()) in chunks, one or a few per entity
+
+    def iter_wikitable(self, rows=None):
+        '''Rows are the wikirow() of each entity, unless already given'''
+        yield ('{| class="ss-table sortable" style="width: 100%;"\n'
             '! Index\n'
             '! ID\n'
             '! Name\n'
             '! Icon\n'
             '! Description\n'
         )
-        table += "".join((_.wikirow() for _ in self))
-        table += '|-\n|}'
-        return table
+        for row in (_.wikirow() for _ in self) if rows is None else rows:
+            yield row
+        yield '|-\n|}'
 
 
-    def wikipage(self):
-        return "\n\n\n".join(_.wikipage().strip() for _ in self)
+    def iter_wikipage(self):
+        return iterjoin("\n\n\n", (_.wikipage().strip() for _ in self))
 
 
-    def dump(self):
-        return [_.dump() for _ in self]
+    def iter_dump(self):
+        yield "["
+        for chunk in iterjoin(", ", (unicode(_.dump()) for _ in self)):
+            yield chunk
+        yield "]"
 
 
-    def pretty(self):
-        return "\n\n".join((_.pretty().strip() for _ in self))
+    def iter_pretty(self):
+        return iterjoin("\n\n", (_.pretty().strip() for _ in self))
 
 
     def bare(self):
@@ -1525,30 +3442,47 @@ class Entities(object):
 
     def get(self, eid, default=None):
         '''Get entity by ID'''
+        if self._order is None and self._view is None:
+            entity = self._entities.get(eid) or self._parse_entity(eid)
+            return default if entity is None else entity
+        if self._order is None:
+            source, _, predicate, window = self._view
+            if predicate is not None and window is None:
+                entity = source.get(eid)
+                if entity is None or not predicate(entity):
+                    return default
+                return entity
+        self._materialize()
         return self._entities.get(eid, default)
 
 
     def __getitem__(self, val):
         if isinstance(val, int):
-            return self._order[val]
+            return self._materialize()[val]
         else:
-            return self.__class__(path=self.path,
-                                  ss=self.ss,
-                                  entities=self._order[val])
+            return self._derive(window=val)
 
 
     def __iter__(self):
-        for entity in self._order:
-            yield entity
+        if self._order is None and self._view is not None:
+            return self._iter_view()
+        return iter(self._materialize())
 
 
     def __len__(self):
-        return len(self._entities)
+        if self._order is None and self._view is None:
+            return len(self._offsets)
+        if self._order is None:
+            source, subset, predicate, window = self._view
+            if predicate is None and window is None:
+                return len(subset)
+            if window is not None and source._order is not None:
+                return len(xrange(*window.indices(len(source._order))))
+        return len(self._materialize())
 
 
     def __unicode__(self):
-        return "<{}: {:d}>".format(self.__class__.__name__,
-                                   len(self._entities))
+        return "<{}: {:d}>".format(self.__class__.__name__, len(self))
 
 
     def __str__(self):
@@ -1560,14 +3494,18 @@ class Qualities(Entities):
     EntityCls=Quality
 
     def usage(self, formatting='pretty'):
+        return "".join(self.iter_usage(formatting))
+
+
+    def iter_usage(self, formatting='pretty'):
         if formatting == 'wikipage':
             func = 'wikipage'
         else:
             func = 'pretty'
 
-        return "\n\n\n\n".join(
+        return iterjoin("\n\n\n\n", (
             "\n\n".join((indent(getattr(_, func)(),0), indent(_.usage())))
-            for _ in self)
+            for _ in self))
 
 
 
@@ -1580,24 +3518,25 @@ class Shops(Entities):
     EntityCls=Shop
 
 
+    @staticmethod
+    def _entity_locations(entity):
+        return entity.locations or ()
+
+
 
 class Events(Entities):
     EntityCls=Event
 
 
-    def at(self, lid=0, name=""):
-        '''Return Events by location ID or name'''
-        return Events(ss=self.ss,
-                      entities=(_ for _
-                                in self
-                                if (_.location and
-                                    ((lid  and _.location.id == lid) or
-                                     (name and re.search(name, _.location.name,
-                                                         re.IGNORECASE))))))
+    @staticmethod
+    def _entity_locations(entity):
+        return (entity.location,) if entity.location else ()
 
 
 
 class SaveQuality(object):
+    __slots__ = ('_data', 'idx', 'ss', 'id', 'quality', 'modifier')
+
     def __init__(self, data=None, idx=0, save=None, ss=None):
         self._data = data
         self.idx   = idx
@@ -1608,9 +3547,7 @@ class SaveQuality(object):
 
         self.quality = ss.qualities.get(self.id)
         if not self.quality:
-            # Create a dummy one
-            self.quality = Quality(data={'Id': self.id, 'Name':''},
-                                   ss=self.ss)
+            self.quality = Quality.dummy(self.id, ss=self.ss, Name='')
             log.warning("Could not find Quality for %r[%d]: %d",
                         save, idx, self.id)
 
@@ -1619,12 +3556,23 @@ class SaveQuality(object):
         self.modifier =  self._data['EffectiveLevelModifier']
 
 
+    def _relink(self):
+        self.quality = self.ss.qualities.get(self.id)
+        if not self.quality:
+            self.quality = Quality.dummy(self.id, ss=self.ss, Name='')
+            log.warning("Could not find Quality for %r: %d", self, self.id)
+
+
     @property
     def name(self):
         # To make SaveQualities.find() work
         return self.quality.name
 
 
+    def _search_texts(self):
+        return (self.name,)
+
+
     @property
     def value(self):
         return self._data['Level']
@@ -1706,43 +3654,669 @@ class SunlessSea(object):
     '''
         Manager class, the one that loads the JSON files
         and call each entity container's constructor
+
+        Containers are created on first access, along with the ones they
+        depend on, so a query only pays for the data files it actually needs
     '''
 
+    # Bump whenever the pickled object graph changes in incompatible ways
+    _SNAPSHOT_VERSION = 10
+
+    # Containers whose entities are referenced by others, by entity type.
+    # In a snapshot such entities are saved as references, not copies
+    _SNAPSHOT_OWNERS = {}  # Filled after all classes are defined
+
+    # Containers that must be created before each container
+    _DEPENDS = {
+        'events':   ('qualities', 'locations'),
+        'autosave': ('qualities',),
+        'settings': ('locations',),
+        'shops':    ('qualities', 'settings'),
+    }
+
+    # Data files read by each container, as _load() arguments
+    _DATAFILES = {
+        'qualities': (dict(entity='qualities'),),
+        'locations': (dict(entity='areas'),),
+        'events':    (dict(entity='events'),),
+        'autosave':  (dict(entity='Autosave', subdir='saves', suffix='',
+                           ordered=True),),
+        'settings':  (dict(entity='Tiles', subdir='geography'),),
+        'shops':     (dict(entity='exchanges'),),
+    }
+
+    # Containers whose data files can be parsed one entity at a time,
+    # either streamed or at byte offsets
+    _STREAMED = ('events',)
+
+
+    def __init__(self, datadir=None, cachedir=None, cache=True, lazy=False,
+                 compact=False, workers=0, processes=False, stream=False,
+                 random_access=False, render_cache=50000, adv_cache=50000):
+        self.datadir  = datadir or get_datadir()
+        self.cache    = cache and not TEST_INTEGRITY  # checks run on build
+        self.lazy     = lazy  and not TEST_INTEGRITY  # Events children
+        self.compact  = compact  # drop raw data, see Entity._compact()
+        self.cachedir = cachedir or (get_cachedir() if self.cache else None)
+        self.workers  = workers  # for preload(), 0 to parse files on demand
+        self.processes = processes  # use a process pool instead of threads
+        self.stream   = stream  # build Events while parsing, see iter_json()
+        self.random_access = random_access  # parse Events on first access
+        # Rendered operators, see QualityOperator._format(). 0 to disable
+        self.render_cache = LRUCache(render_cache) if render_cache else None
+        # Compiled Advanced strings, see Entity._compile_adv(). 0 to disable
+        self.adv_cache = LRUCache(adv_cache) if adv_cache else None
+        self.ports    = None  # soon!
+
+        self._sources  = {}  # container: {path: (size, mtime)} it depends on
+        self._loaded   = {}  # sources read by the container being created
+        self._pickling = None  # container being saved to a snapshot
+        self._strings  = {}  # interned strings, see intern()
+        self._dummies  = {}  # (class, id): placeholder, see Entity.dummy()
+        self._shared   = collections.Counter()  # see sharing_report()
+        self._pending  = {}  # path: async result of a preload() parse
+
+
+    @lazyattr
+    def qualities(self):
+        return self._container('qualities')
+
+
+    @lazyattr
+    def locations(self):
+        # Settings are created along, to set Location.setting. Their data
+        # file is small, and they depend on locations, so those come first
+        locations = self.__dict__['locations'] = self._container('locations')
+        self.settings
+        return locations
+
+
+    @lazyattr
+    def events(self):
+        return self._container('events')
+
+
+    @lazyattr
+    def autosave(self):
+        return self._container('autosave')
+
+
+    @lazyattr
+    def settings(self):
+        # Not yet a first-class citizen
+        settings = self._container('settings')
+        self._link_settings(settings)
+        return settings
 
-    def __init__(self, datadir=None):
-        self.datadir = datadir or get_datadir()
-        self.qualities = Qualities(ss=self, **self._load('qualities'))
-        self.locations = Locations(ss=self, **self._load('areas'))
-        self.events    = Events(   ss=self, **self._load('events'))
-        self.autosave  = Save(     ss=self, **self._load('Autosave', 'saves',
-                                                         '', ordered=True))
 
-        # Not yet a first-class citizen
-        self.settings = self._create_settings()
+    def _link_settings(self, settings):
+        for sid, setting in settings.iteritems():
+            for location in setting['locations']:
+                location.setting = sid
+
 
+    @lazyattr
+    def shops(self):
         # First class, requires self.settings, constructor still messy
-        self.shops = Shops(entities=(_ for _ in self._create_shop()), ss=self)
-        self.ports = None  # soon!
-
-        # Add 'LinkToEvent' references
-        for event in self.events:
-            for action in event.actions:
-                for outcome in action.outcomes:
-                    trigger = outcome.trigger
-                    if type(trigger) is not int:
-                        continue
-
-                    outcome.trigger = self.events.get(trigger)
-                    if outcome.trigger:
-                        continue
-
-                    # Create a dummy one
-                    outcome.trigger = Event(ss=self,
-                                            data=dict(Id=trigger,
-                                                      ChildBranches=[],
-                                                      QualitiesRequired=[]))
-                    log.error("%r.%r.%r links to a non-existant event: %d",
-                              event, action, outcome, trigger)
+        return self._container('shops')
+
+
+    @lazyattr
+    def references(self):
+        '''Reverse index of Quality ID: list of references to it,
+            as (parents..., item) tuples. See Quality.references()
+        '''
+        references = {}
+        for ref in self._walk():
+            item = ref[-1]
+            if isinstance(item, QualityOperator):
+                qids = (item.quality.id,)
+            elif isinstance(item, ShopItem):
+                qids = set((item.item.id, item.currency.id))
+            else:
+                continue
+            for qid in qids:
+                references.setdefault(qid, []).append(ref)
+        return references
+
+
+    @lazyattr
+    def advanced_references(self):
+        '''Reverse index of Quality ID: list of entities mentioning it in
+            Advanced strings, as (parents..., item) tuples.
+            Each string is tokenized only once, when the index is built
+        '''
+        references = {}
+        for ref in self._walk():
+            qids = set()
+            for text in ref[-1]._advanced_texts():
+                qids.update(Entity._adv_qids(text, self))
+            for qid in qids:
+                references.setdefault(qid, []).append(ref)
+        return references
+
+
+    def outdated(self):
+        '''Names of created containers whose data files changed since'''
+        return [name for name, sources in self._sources.iteritems()
+                if any(not self._source_key(path) == key
+                       for path, key in sources.iteritems())]
+
+
+    def reload(self):
+        '''Reload created containers whose own data files changed, and
+            link the containers depending on them to the new entities.
+            Entities whose data did not change are kept, so references to
+            them remain valid. Settings are always created anew.
+            Return the names of the containers reloaded or relinked
+        '''
+        done = {}  # name: True if reloaded, False if relinked
+        for name in self._dependency_order():
+            if name not in self.__dict__:
+                continue
+            own = self._own_sources(name)
+            changed = any(not self._source_key(path) == own[path]
+                          for path in own)
+            depends = [_ for _ in self._DEPENDS.get(name, ()) if done.get(_)]
+            if not (changed or depends):
+                continue
+
+            old = self.__dict__.pop(name)
+            if changed or name == 'settings':
+                log.info("Reloading %s", name)
+                new = getattr(self, name)
+                if isinstance(new, Entities):
+                    self._merge(old, new)
+                done[name] = True
+                continue
+
+            # Only a dependency changed. Entities are kept, and so are the
+            # sources of this container, but those of the dependencies
+            log.info("Relinking %s to %s", name, ", ".join(depends))
+            entities = old.qualities if isinstance(old, Save) else old
+            capture = _LogCapture()
+            log.addHandler(capture)
+            try:
+                for entity in entities._parsed():
+                    entity._relink()
+            finally:
+                log.removeHandler(capture)
+            entities._indexes = {}
+            entities._searched = set()
+            sources = dict(own)
+            for dep in self._DEPENDS[name]:
+                sources.update(self._sources[dep])
+            self._sources[name] = sources
+            self.__dict__[name] = old
+            if self.cache and not (self.random_access and
+                                   name in self._STREAMED):
+                self._save_snapshot(name, old, capture.messages)
+            done[name] = False
+
+        if done:
+            # Reverse indexes are built again on demand
+            self.__dict__.pop('references', None)
+            self.__dict__.pop('advanced_references', None)
+            if self.render_cache is not None:
+                self.render_cache.clear()
+            if self.adv_cache is not None:
+                self.adv_cache.clear()
+        return [_ for _ in self._dependency_order() if _ in done]
+
+
+    def diff(self, other):
+        '''Compare with another SunlessSea, usually another game version.
+            Return {container name: EntitiesDiff}, see Entities.diff()
+        '''
+        return collections.OrderedDict(
+            (name, self._hashed(name).diff(other._hashed(name)))
+            for name in ('qualities', 'locations', 'events', 'shops'))
+
+
+    def _hashed(self, name):
+        '''A container with its hash tree, see Entities._merkle_tree(). The
+            tree is read from a file next to the snapshots if its data files
+            did not change, or else built and saved there. Content hashes
+            depend only on an entity's own data, so on those files only
+        '''
+        container = getattr(self, name)
+        if container._merkle is not None or not self.cache:
+            return container
+
+        path = os.path.join(os.path.dirname(self._snapshot_path(name)),
+                            name + ".hashes")
+        sources = self._own_sources(name)
+        try:
+            with open(path, 'rb') as fd:
+                version, saved, tree = pickle.load(fd)
+            if version == self._SNAPSHOT_VERSION and saved == sources:
+                log.debug("Loaded hashes for '%-9s': %s", name, path)
+                container._merkle = tree
+                return container
+        except Exception as e:
+            log.debug("Could not read hashes %s: %s", path, e)
+
+        tree = container._merkle_tree()
+        temp = "{}.{}.tmp".format(path, os.getpid())
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(temp, 'wb') as fd:
+                pickle.dump((self._SNAPSHOT_VERSION, sources, tree), fd,
+                            pickle.HIGHEST_PROTOCOL)
+            if sys.platform == "win32" and os.path.exists(path):
+                os.remove(path)  # rename() does not overwrite on Windows
+            os.rename(temp, path)
+        except (IOError, OSError) as e:
+            log.debug("Could not save hashes %s: %s", path, e)
+            if os.path.exists(temp):
+                os.remove(temp)
+        else:
+            log.debug("Saved hashes for '%-9s': %s", name, path)
+        return container
+
+
+    def _merge(self, old, new):
+        # Keep old entities with unchanged data in a reloaded container
+        if new._order is None:
+            return  # random access, parsed on demand
+        kept = []
+        for i, entity in enumerate(new._order):
+            twin = old._entities.get(entity.id)
+            if twin is not None and same_data(twin.dump(), entity.dump()):
+                twin.idx = entity.idx
+                new._order[i] = new._entities[entity.id] = twin
+                kept.append(twin)
+        # Once all are in place, as events link to other events
+        for entity in kept:
+            entity._relink()
+        log.debug("Kept %d of %d %s", len(kept), len(new._order),
+                  new.__class__.__name__)
+
+
+    def _own_sources(self, name):
+        '''{path: key} of the data files a container read itself'''
+        paths = (os.path.abspath(self._data_path(**_))
+                 for _ in self._DATAFILES[name])
+        return {_: self._sources[name].get(_) for _ in paths}
+
+
+    def _dependency_order(self):
+        '''Names of all containers, each after its dependencies'''
+        order = []
+        def visit(name):
+            if name not in order:
+                for dep in self._DEPENDS.get(name, ()):
+                    visit(dep)
+                order.append(name)
+        for name in sorted(self._DATAFILES):
+            visit(name)
+        return order
+
+
+    def preload(self, *names):
+        '''Start parsing data files for containers and their dependencies
+            in a pool of self.workers threads or processes, skipping those
+            with an up to date snapshot. Containers are still created on
+            first access, each waiting only for its own files
+        '''
+        if not self.workers:
+            return
+
+        paths, todo = collections.OrderedDict(), list(names)
+        while todo:
+            name = todo.pop()
+            todo.extend(self._DEPENDS.get(name, ()))
+            if (name in self.__dict__ or
+                ((self.stream or self.random_access) and
+                 name in self._STREAMED) or
+                (self.cache and self._snapshot_valid(name))):
+                continue
+            for kwargs in self._DATAFILES[name]:
+                path = self._data_path(**kwargs)
+                if path not in self._pending:
+                    paths[path] = kwargs.get('ordered', False)
+
+        if not paths:
+            return
+
+        if self.processes:
+            # Strings are interned per file, and shared only within it.
+            # Parsed data is pickled back here, which often costs more
+            # than the parsing done in parallel saves
+            pool, intern = multiprocessing.Pool(self.workers), None
+        else:
+            pool, intern = (multiprocessing.pool.ThreadPool(self.workers),
+                            self.intern)
+        log.debug("Preloading %d data files with %d %s", len(paths),
+                  self.workers, iif(self.processes, "processes", "threads"))
+        for path, ordered in paths.iteritems():
+            self._pending[path] = pool.apply_async(load_json,
+                                                   (path, ordered, intern))
+        pool.close()
+
+
+    def intern(self, text):
+        '''Return the shared copy of a string, so repeated ones are stored
+            once. Built-in intern() only takes byte strings
+        '''
+        shared = self._strings.setdefault(text, text)
+        if shared is not text:
+            self._shared['strings'] += 1
+            self._shared['strings_bytes'] += sys.getsizeof(text)
+        return shared
+
+
+    def sharing_report(self):
+        '''Memory saved by interned strings and shared dummy entities,
+            in objects built so far. Snapshots keep sharing within a container
+        '''
+        shared = self._shared  # a Counter, so 0 for missing keys
+        return ("Shared {} strings ({} bytes), {} dummy entities ({} bytes)"
+                .format(shared['strings'], shared['strings_bytes'],
+                        shared['dummies'], shared['dummies_bytes']))
+
+
+    def _walk(self):
+        '''All entities, children included, as (parents..., item) tuples'''
+        for q in self.qualities:
+            yield (q,)
+
+        for l in self.locations:
+            yield (l,)
+
+        for e in self.events:
+            yield (e,)
+            for r in e.requirements:
+                yield (e, r)
+            for f in e.effects:
+                yield (e, f)
+            for a in e.actions:
+                yield (e, a)
+                for r in a.requirements:
+                    yield (e, a, r)
+                for o in a.outcomes:
+                    yield (e, a, o)
+                    for f in o.effects:
+                        yield (e, a, o, f)
+
+        for s in self.shops:
+            yield (s,)
+            for i in s.items:
+                yield (s, i)
+
+
+    def _container(self, name):
+        '''Create a container, or restore it from its snapshot.
+            Containers it depends on are created first, and their sources
+            are also part of this container's snapshot key
+        '''
+        sources = {}
+        for dep in self._DEPENDS.get(name, ()):
+            getattr(self, dep)
+            sources.update(self._sources[dep])
+
+        # Entities parsed on first access are compacted then, and a snapshot
+        # would parse them all
+        random_access = self.random_access and name in self._STREAMED
+        cache = self.cache and not random_access
+
+        container = self._load_snapshot(name) if cache else None
+        if container is not None:
+            return container
+
+        # Warnings about the data are saved in the snapshot, to be logged
+        # again when it is loaded
+        capture = _LogCapture()
+        log.addHandler(capture)
+        try:
+            self._loaded = sources
+            container = getattr(self, '_create_' + name)()
+            self._sources[name], self._loaded = self._loaded, {}
+
+            # Also creates all Event children, even in lazy mode
+            if (self.compact and not random_access and
+                isinstance(container, Entities)):
+                for entity in container:
+                    entity._compact()
+        finally:
+            log.removeHandler(capture)
+        log.debug(self.sharing_report())
+
+        if cache:
+            self._save_snapshot(name, container, capture.messages)
+        return container
+
+
+    def _create_qualities(self):
+        return Qualities(ss=self, **self._load('qualities'))
+
+
+    def _create_locations(self):
+        return Locations(ss=self, **self._load('areas'))
+
+
+    def _create_events(self):
+        if self.random_access:
+            path = self._data_path('events')
+            self._loaded[os.path.abspath(path)] = self._source_key(path)
+            offsets = self._json_offsets(path)
+            if offsets is not None:
+                return Events(ss=self, path=path, offsets=offsets)
+
+        if not self.stream:
+            return Events(ss=self, **self._load('events'))
+
+        # In compact mode each event's raw data is dropped as soon as it is
+        # built, so peak memory is about the size of the final Events
+        loaded = self._load('events', stream=True)
+        return Events(ss=self, path=loaded['path'],
+                      entities=self._stream_entities(Event, loaded['data']))
+
+
+    def _stream_entities(self, cls, data):
+        for idx, edata in enumerate(data, 1):
+            entity = cls(data=edata, idx=idx, ss=self)
+            if self.compact:
+                entity._compact()
+            yield entity
+
+
+    def _create_autosave(self):
+        return Save(ss=self, **self._load('Autosave', 'saves', '',
+                                          ordered=True))
+
+
+    def _create_shops(self):
+        return Shops(entities=(_ for _ in self._create_shop()), ss=self)
+
+
+    def _snapshot_path(self, name):
+        datadir = os.path.abspath(self.datadir)
+        if isinstance(datadir, unicode):
+            datadir = datadir.encode('utf-8')
+        return os.path.join(self.cachedir,
+                            hashlib.md5(datadir).hexdigest(),
+                            "{}{}.pickle".format(name, iif(self.compact,
+                                                           "-compact")))
+
+
+    def _source_key(self, path):
+        '''Snapshot key of a data file. None if it does not exist'''
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return (stat.st_size, stat.st_mtime)
+
+
+    def _json_offsets(self, path):
+        '''Byte offset index of a data file, as {id: (idx, offset, length)}.
+            Read from "<path>.idx" next to the data file, or in the cache
+            directory, and built and saved there if missing or outdated.
+            None if the data file can't be read
+        '''
+        key = self._source_key(path)
+        if key is None:
+            return None
+
+        paths = ["{}.idx".format(path)]
+        if self.cachedir:
+            paths.append(os.path.join(
+                os.path.dirname(self._snapshot_path('events')),
+                "{}.idx".format(os.path.basename(path))))
+
+        offsets = None
+        for idxpath in paths:
+            try:
+                with open(idxpath) as fd:
+                    index = json.load(fd)
+                if (index['version'] == self._SNAPSHOT_VERSION and
+                    tuple(index['source']) == key):
+                    log.debug("Loaded offsets index: %s", idxpath)
+                    offsets = index['offsets']
+                    break
+            except (IOError, ValueError, KeyError, TypeError) as e:
+                log.debug("Could not read offsets index %s: %s", idxpath, e)
+
+        if offsets is None:
+            offsets = self._save_offsets(path, key, paths)
+        if offsets is None:
+            return None
+
+        return {eid: (idx, offset, length)
+                for idx, (eid, offset, length) in enumerate(offsets, 1)}
+
+
+    def _save_offsets(self, path, key, paths):
+        # Save to the first writable path, the data dir may be read-only
+        log.info("Indexing data file, only needed once: %s", path)
+        try:
+            offsets = [(item['Id'], offset, length) for item, offset, length
+                       in iter_json(path, offsets=True)]
+        except IOError as e:
+            log.error("Could not index data file %s: %s", path, e)
+            return None
+
+        index = dict(version=self._SNAPSHOT_VERSION, source=key,
+                     offsets=offsets)
+        for idxpath in paths:
+            temp = "{}.{}.tmp".format(idxpath, os.getpid())
+            try:
+                if not os.path.isdir(os.path.dirname(idxpath)):
+                    os.makedirs(os.path.dirname(idxpath))
+                with open(temp, 'w') as fd:
+                    json.dump(index, fd, separators=(',', ':'))
+                if sys.platform == "win32" and os.path.exists(idxpath):
+                    os.remove(idxpath)  # rename() does not overwrite
+                os.rename(temp, idxpath)
+            except (IOError, OSError) as e:
+                log.debug("Could not save offsets index %s: %s", idxpath, e)
+                if os.path.exists(temp):
+                    os.remove(temp)
+                continue
+            log.debug("Saved offsets index: %s", idxpath)
+            break
+        return offsets
+
+
+    def _load_snapshot(self, name):
+        '''Restore a container from its snapshot, if still up to date.
+            Return None if there is no valid snapshot
+        '''
+        path = self._snapshot_path(name)
+        try:
+            with open(path, 'rb') as fd:
+                unpickler = pickle.Unpickler(fd)
+                unpickler.persistent_load = self._persistent_load
+
+                version, sources = unpickler.load()
+                if not version == self._SNAPSHOT_VERSION:
+                    log.debug("Snapshot version %s is outdated: %s",
+                              version, path)
+                    return None
+                for source, key in sources.iteritems():
+                    if not self._source_key(source) == key:
+                        log.debug("Snapshot is outdated, %s changed", source)
+                        return None
+
+                with gc_paused():
+                    container = unpickler.load()
+                warnings = unpickler.load()
+        except IOError as e:
+            log.debug("Could not read snapshot: %s", e)
+            return None
+        except Exception as e:
+            log.warning("Ignoring invalid snapshot %s: %s", path, e)
+            return None
+
+        log.debug("Loaded snapshot for '%-9s': %s", name, path)
+        for level, message in warnings:
+            log.log(level, "%s", message)
+        self._sources[name] = sources
+        return container
+
+
+    def _snapshot_valid(self, name):
+        '''Whether a container has an up to date snapshot, reading only the
+            snapshot header
+        '''
+        try:
+            with open(self._snapshot_path(name), 'rb') as fd:
+                version, sources = pickle.load(fd)
+        except Exception:
+            return False
+        return (version == self._SNAPSHOT_VERSION and
+                all(self._source_key(source) == key
+                    for source, key in sources.iteritems()))
+
+
+    def _save_snapshot(self, name, container, warnings=()):
+        path = self._snapshot_path(name)
+        temp = "{}.{}.tmp".format(path, os.getpid())
+        self._pickling = name
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(temp, 'wb') as fd, gc_paused():
+                pickler = pickle.Pickler(fd, pickle.HIGHEST_PROTOCOL)
+                # Called only for class instances, unlike persistent_id
+                pickler.inst_persistent_id = self._persistent_id
+                pickler.dump((self._SNAPSHOT_VERSION, self._sources[name]))
+                pickler.dump(container)
+                pickler.dump(list(warnings))
+            if sys.platform == "win32" and os.path.exists(path):
+                os.remove(path)  # rename() does not overwrite on Windows
+            os.rename(temp, path)
+        except (IOError, OSError, pickle.PicklingError) as e:
+            log.warning("Could not save snapshot %s: %s", path, e)
+            if os.path.exists(temp):
+                os.remove(temp)
+            return
+        finally:
+            self._pickling = None
+        log.debug("Saved snapshot for '%-9s': %s", name, path)
+
+
+    def _persistent_id(self, obj):
+        # Entities reference their manager, which is never pickled
+        if obj is self:
+            return "ss"
+
+        # ... nor are entities owned by other containers
+        owner = self._SNAPSHOT_OWNERS.get(type(obj))
+        if (owner and not owner == self._pickling and
+            getattr(self, owner).get(obj.id) is obj):
+            return (owner, obj.id)
+
+        return None
+
+
+    def _persistent_load(self, pid):
+        if pid == "ss":
+            return self
+        owner, eid = pid
+        return getattr(self, owner).get(eid)
 
 
     def _create_shop(self):
@@ -1755,7 +4329,8 @@ class SunlessSea(object):
 
             for shop in exchange['Shops']:
                 i+=1
-                yield Shop(data=shop, idx=i, ss=self, locations=locations)
+                yield Shop(data=shop, idx=i, ss=self, locations=locations,
+                           settings=tuple(exchange['SettingIds']))
 
 
     def _create_settings(self):
@@ -1776,11 +4351,8 @@ class SunlessSea(object):
                     areas[aid] = sid
 
                 location = self.locations.get(aid, None)
-                if location:
-                    location.setting = sid
-                else:
-                    # Dummy
-                    location = Location(data={'Id': aid}, ss=self)
+                if not location:
+                    location = Location.dummy(aid, ss=self)
                     log.error("Location not found for port (%s): %s",
                               ", ".join(item), aid)
 
@@ -1797,17 +4369,32 @@ class SunlessSea(object):
         return settings
 
 
-    def _load(self, entity, subdir='entities', suffix="_import", ordered=False):
-        path = os.path.join(self.datadir,
+    def _data_path(self, entity, subdir='entities', suffix="_import",
+                   ordered=False):
+        return os.path.join(self.datadir,
                             subdir,
                             "{}{}.json".format(entity, suffix))
-        log.debug("Opening data file for '%-9s': %s", entity, path)
+
+
+    def _load(self, entity, subdir='entities', suffix="_import", ordered=False,
+              stream=False):
+        '''Load a data file, as dict(path, data). If stream, data is an
+            iterator over the items of its top-level array, see iter_json()
+        '''
+        path = self._data_path(entity, subdir, suffix)
+        self._loaded[os.path.abspath(path)] = self._source_key(path)
         try:
-            with open(path) as fd:
-                # strict=False to allow tabs inside strings
-                return dict(path=path, data=json.load(fd, strict=False,
-                        object_pairs_hook=(collections.OrderedDict
-                                           if ordered else None)))
+            pending = self._pending.pop(path, None)
+            if stream and not pending:
+                log.debug("Streaming data file for '%-9s': %s", entity, path)
+                data = iter_json(path, ordered, self.intern)
+            elif pending:
+                log.debug("Waiting data file for '%-9s': %s", entity, path)
+                data = pending.get()
+            else:
+                log.debug("Opening data file for '%-9s': %s", entity, path)
+                data = load_json(path, ordered, self.intern)
+            return dict(path=path, data=data)
         except IOError as e:
             log.error("Could not load data file for '%s': %s", entity, e)
             return dict(path=path, data={})
@@ -1815,12 +4402,23 @@ class SunlessSea(object):
 
 
 
+SunlessSea._SNAPSHOT_OWNERS.update({
+    Quality:  'qualities',
+    Location: 'locations',
+})
+
+
+
+
 ################################################################################
 # Import guard
 
 if __name__ == '__main__':
+    # Run the imported module instead of this __main__ one, so snapshots
+    # pickle classes as sunlesssea.*, the same as when used as a library
+    import sunlesssea
     try:
-        sys.exit(main(sys.argv[1:]))
+        sys.exit(sunlesssea.main(sys.argv[1:]))
     except Exception as e:
         log.critical(e, exc_info=True)
         sys.exit(1)